@@ -0,0 +1,218 @@
+"""Times the hessian backends and approximations across the model zoo.
+
+Every (model, batch size, method) case runs in a fresh process, so that the
+peak rss of a case is not hidden by the cases before it. The approximation
+error is the relative error of the hessian diagonal against the exact
+diagonal of J^T J, backpropagated in chunks of output dimensions that fit in
+--reference_max_bytes. Cases that a backend doesn't support (e.g. backpack
+has no Upsample extension) are reported as skipped, with the reason.
+
+cd src; python -m benchmarks.hessian_backends --models mnist_conv --batch_sizes 8 32
+"""
+import argparse
+import json
+import platform
+import resource
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from datetime import datetime
+from multiprocessing import get_context
+
+import torch
+
+input_shapes = {
+    "mnist": (1, 28, 28),
+    "mnist_conv": (1, 28, 28),
+    "fashionmnist": (1, 28, 28),
+    "fashionmnist_conv": (1, 28, 28),
+    "cifar10": (3, 32, 32),
+    "cifar10_conv": (3, 32, 32),
+    "svhn_conv": (3, 32, 32),
+    "celeba_conv": (3, 64, 64),
+}
+
+methods = ["layer/exact", "layer/approx", "layer/mix", "layer/block", "layer/kfac", "backpack", "rowwise"]
+
+
+def get_model(encoder, decoder):
+
+    net = OrderedDict(encoder.encoder._modules)
+    decoder = decoder.decoder._modules
+    max_ = max([int(i) for i in net.keys()])
+    for i in decoder.keys():
+        net.update({f"{max_+int(i) + 1}": decoder[i]})
+
+    return torch.nn.Sequential(net)
+
+
+def hessian_diagonal(method, hessian):
+    """diagonal [P] of the hessian of any of the methods"""
+    if method == "layer/block":
+        return torch.cat([torch.diagonal(h) for h in hessian])
+    if method == "layer/kfac":
+        # G (x) A, with the weights [out, in] first and then the bias
+        diag = []
+        for A, G, bias in hessian:
+            a, g = torch.diagonal(A), torch.diagonal(G)
+            if bias:
+                diag += [torch.outer(g, a[:-1]).flatten(), g * a[-1]]
+            else:
+                diag += [torch.outer(g, a).flatten()]
+        return torch.cat(diag)
+    return hessian.flatten()
+
+
+def reference_diagonal(net, x, max_bytes):
+    """exact diagonal [P] of J^T J, with as many output dimensions per chunk
+    as fit in max_bytes (see layerwise.chunked_exact_diag)"""
+    from hessian import layerwise as lw
+
+    feature_maps = [x]
+    with torch.no_grad():
+        for layer in net:
+            feature_maps.append(layer.forward(feature_maps[-1]))
+
+    width = max(
+        [f[0].numel() for f in feature_maps] + [sum(p.numel() for p in layer.parameters()) for layer in net]
+    )
+    output_size = feature_maps[-1][0].numel()
+    chunk_size = int(min(output_size, max(1, max_bytes // (4 * x.shape[0] * width))))
+    return lw.chunked_exact_diag(net, feature_maps, output_size, chunk_size)
+
+
+def rss_mb():
+    # linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(model, batch_size, method, repeats, reference_max_bytes, seed=0):
+    from hessian import backpack as bp
+    from hessian import layerwise as lw
+    from hessian import rowwise as rw
+    from models import decoders, encoders, stochman_decoders, stochman_encoders
+
+    torch.manual_seed(seed)
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    latent_size = 2
+
+    # the reference is computed on the net of the calculator
+    net = get_model(
+        stochman_encoders[model](latent_size, 0), stochman_decoders[model](latent_size, 0)
+    ).to(device)
+    x = torch.rand(batch_size, *input_shapes[model], device=device)
+    n_params = sum(p.numel() for p in net.parameters())
+
+    feature_maps = []
+    for layer in net:
+        layer.register_forward_hook(lambda module, input, output: feature_maps.append(output.detach()))
+
+    if method == "backpack":
+        net = get_model(encoders[model](latent_size, 0), decoders[model](latent_size, 0)).to(device)
+        n_params = sum(p.numel() for p in net.parameters())
+        # extending the net adds backward hooks, that torch.func can't trace
+        reference_net = deepcopy(net)
+        calculator = bp.MseHessianCalculator(net)
+
+        def compute():
+            return calculator.compute_batch(x)
+
+    elif method == "rowwise":
+        calculator = rw.MseHessianCalculator("diag", chunk_size=64)
+
+        def compute():
+            return calculator.compute_batch(net, x[0].numel(), x)
+
+    else:
+        calculator = lw.MseHessianCalculator(method.split("/")[1])
+
+        def compute():
+            feature_maps.clear()
+            with torch.no_grad():
+                net(x)
+            return calculator(net, list(feature_maps), x)
+
+    baseline_rss = rss_mb()
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+    # the first call is a warm up, backpack raises NotImplementedError for
+    # modules without an extension
+    try:
+        hessian = compute()
+    except NotImplementedError as e:
+        return {"model": model, "batch_size": batch_size, "method": method, "skipped": str(e)}
+    times = []
+    for _ in range(repeats):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.time()
+        hessian = compute()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.time() - start)
+
+    result = {
+        "model": model,
+        "batch_size": batch_size,
+        "method": method,
+        "n_params": n_params,
+        "wall_time_s": min(times),
+        "wall_time_mean_s": sum(times) / len(times),
+        "baseline_rss_mb": baseline_rss,
+        "peak_rss_mb": rss_mb(),
+        "peak_cuda_mb": torch.cuda.max_memory_allocated() / 2**20 if torch.cuda.is_available() else None,
+        "relative_error": None,
+    }
+
+    # the rowwise jacobians are exact, the others against the chunked exact diagonal
+    if method != "rowwise":
+        diag_ref = reference_diagonal(reference_net if method == "backpack" else net, x, reference_max_bytes)
+        diag = hessian_diagonal(method, hessian).to(diag_ref.device)
+        result["relative_error"] = ((diag - diag_ref).norm() / diag_ref.norm()).item()
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", nargs="+", default=["mnist", "mnist_conv", "fashionmnist_conv", "cifar10_conv", "celeba_conv"])
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[8, 32, 128])
+    parser.add_argument("--methods", nargs="+", default=methods, choices=methods)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--reference_max_bytes", type=float, default=2**31)
+    parser.add_argument("--out", type=str, default="benchmarks/hessian_backends.json")
+    args = parser.parse_args()
+
+    results = []
+    for model in args.models:
+        for batch_size in args.batch_sizes:
+            for method in args.methods:
+                # a fresh process per case, so that peak rss is per case
+                with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+                    future = executor.submit(
+                        run_case, model, batch_size, method, args.repeats, args.reference_max_bytes
+                    )
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {"model": model, "batch_size": batch_size, "method": method, "error": repr(e)}
+                print(json.dumps(result), flush=True)
+                results.append(result)
+
+    report = {
+        "date": datetime.now().isoformat(),
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cuda": torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+        "n_threads": torch.get_num_threads(),
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
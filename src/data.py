@@ -7,39 +7,112 @@ import pandas as pd
 from functools import partial
 from PIL import Image
 import os
+from multiprocessing import Pool
+from tqdm import tqdm
+
+
+def celeba_files(root):
+    fn = partial(os.path.join, root, "celeba")
+    csv_file = pd.read_csv(fn("list_attr_celeba.txt"), index_col=0)
+    splits = (
+        pd.read_csv(fn("list_eval_partition.txt"), delimiter=" ", header=None)
+        .values[:, 1]
+        .astype(int)
+    )
+
+    filename = csv_file["image_id"].values
+    target = csv_file.values[:, 1:].astype(int)
+    return fn, filename, target, splits
+
+
+def load_celeba_image(args):
+    path, size = args
+    try:
+        image = Image.open(path).convert("RGB")
+    except FileNotFoundError:
+        return None
+    image = transforms.Resize(size)(image)
+    return np.asarray(image).transpose(2, 0, 1)
+
+
+def pack_celeba(root, size=(64, 64), n_workers=None):
+    """decodes and resizes all images once into a uint8 [N, 3, H, W] array in
+    the order of list_attr_celeba.txt, and marks the missing files"""
+    fn, filename, _, _ = celeba_files(root)
+    path = fn(f"packed_{size[0]}x{size[1]}")
+    if os.path.isfile(f"{path}_missing.npy"):
+        return path
+
+    # written to a temporary file first, so a crash never leaves a broken store
+    images = np.lib.format.open_memmap(
+        f"{path}_images.npy.tmp", mode="w+", dtype=np.uint8, shape=(len(filename), 3, *size)
+    )
+    missing = np.zeros(len(filename), dtype=bool)
+
+    jobs = [(fn("img_align_celeba", f), size) for f in filename]
+    with Pool(n_workers) as pool:
+        for i, image in enumerate(tqdm(pool.imap(load_celeba_image, jobs, chunksize=256), total=len(jobs))):
+            if image is None:
+                missing[i] = True
+            else:
+                images[i] = image
+
+    images.flush()
+    del images
+    os.replace(f"{path}_images.npy.tmp", f"{path}_images.npy")
+    # the missing files are written last, they mark the store as complete
+    save_npy(f"{path}_missing.npy", missing)
+    if missing.any():
+        print(f"==> {missing.sum()} celeba images not found: {list(filename[missing][:10])}")
+
+    return path
 
 
 class CelebA(torch.utils.data.Dataset):
-    def __init__(self, root, split="train", transform=None):
+    def __init__(self, root, split="train", transform=None, packed_size=None):
 
         self.transform = transform
         self.root = root
-        self.fn = partial(os.path.join, self.root, "celeba")
-        csv_file = pd.read_csv(self.fn("list_attr_celeba.txt"), index_col=0)
-        splits = (
-            pd.read_csv(self.fn("list_eval_partition.txt"), delimiter=" ", header=None)
-            .values[:, 1]
-            .astype(int)
-        )
-
-        filename = csv_file["image_id"].values
-        target = csv_file.values[:, 1:].astype(int)
+        self.fn, filename, target, splits = celeba_files(root)
         split_map = {"train": 0, "val": 1, "test": 2, "all": None}
 
         mask = splits == split_map[split]
+
+        # read from the packed store, the missing images are left out
+        self.images, self.path = None, None
+        if packed_size is not None:
+            assert transform is None, "the packed images are already resized"
+            path = pack_celeba(root, packed_size)
+            self.images, self.path = np.load(f"{path}_images.npy", mmap_mode="c"), path
+            mask = mask & ~np.load(f"{path}_missing.npy")
+            self.rows = np.nonzero(mask)[0]
+
         self.filename = filename[mask]
         self.target = target[mask]
 
     def __len__(self):
         return len(self.target)
 
+    # pickled (e.g. for spawned workers) with the path of the packed store
+    # rather than a copy of the images, the memory map is opened again
+    def __getstate__(self):
+        return {**self.__dict__, "images": None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            self.images = np.load(f"{self.path}_images.npy", mmap_mode="c")
+
     def __getitem__(self, idx):
 
+        if self.images is not None:
+            return torch.from_numpy(self.images[self.rows[idx]]).float().div_(255), self.target[idx]
+
         try:
             image = Image.open(self.fn("img_align_celeba", self.filename[idx]))
             image = self.transform(image)
             target = self.target[idx]
-        except:
+        except FileNotFoundError:
             print(self.filename[idx], " not found")
             image = Image.open(self.fn("img_align_celeba", self.filename[0]))
             image = self.transform(image)
@@ -47,8 +120,125 @@ class CelebA(torch.utils.data.Dataset):
 
         return image, target
 
+    def __getitems__(self, indices):
+        if self.images is None:
+            return [self[idx] for idx in indices]
+
+        # a whole batch of the packed store at once (see collate_batch)
+        rows = self.rows[indices]
+        if np.all(np.diff(rows) == 1):
+            rows = slice(rows[0], rows[-1] + 1)
+        x = torch.from_numpy(self.images[rows]).float().div_(255)
+        return x, torch.from_numpy(self.target[indices])
+
+
+class CachedImages(torch.utils.data.Dataset):
+    """uint8 images [N, C, H, W] and labels of a cached split, memory mapped.
+    A batch is sliced at once and scaled to [0, 1] like ToTensor, so it is
+    loaded with collate_fn=collate_batch"""
+
+    def __init__(self, path):
+        self.path = path
+        # copy on write, so the slices are writable tensors
+        self.images = np.load(f"{path}_images.npy", mmap_mode="c")
+        self.labels = np.load(f"{path}_labels.npy", mmap_mode="c")
+
+    def __len__(self):
+        return len(self.labels)
+
+    # pickled (e.g. for spawned workers) with the path rather than a copy of
+    # the arrays, the memory maps are opened again
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def __getitem__(self, idx):
+        x, y = self.__getitems__([idx])
+        return x[0], y[0]
+
+    def __getitems__(self, indices):
+        # the sequential batches are contiguous slices
+        if list(indices) == list(range(indices[0], indices[0] + len(indices))):
+            indices = slice(indices[0], indices[-1] + 1)
+        x = torch.from_numpy(self.images[indices]).float().div_(255)
+        y = torch.from_numpy(self.labels[indices])
+        return x, y
+
+
+def collate_batch(batch):
+    return batch
 
-def get_data(name, batch_size=32, root_dir = "../data/"):
+
+# torchvision dataset, its arguments and the lengths of the fixed train/val split
+cached_datasets = {
+    "mnist": (MNIST, {"train": True}, [55000, 5000]),
+    "kmnist": (KMNIST, {"train": True}, [55000, 5000]),
+    "fashionmnist": (FashionMNIST, {"train": True}, [55000, 5000]),
+    "svhn": (SVHN, {"split": "train"}, [73257 - 5000, 5000]),
+    "cifar10": (CIFAR10, {"train": True}, [45000, 5000]),
+}
+
+
+def save_npy(path, array):
+    # write to a temporary file first, so a crash never leaves a broken cache
+    with open(f"{path}.tmp", "wb") as f:
+        np.save(f, np.ascontiguousarray(array))
+    os.replace(f"{path}.tmp", path)
+
+
+def cache_dataset(name, root_dir):
+    """converts the dataset once to uint8 [N, C, H, W] images and int64 labels,
+    stored as contiguous arrays per split of the fixed random_split (seed 42)"""
+    path = os.path.join(root_dir, "cache", name)
+    if os.path.isfile(f"{path}_val_labels.npy"):
+        return path
+
+    Dataset, kwargs, lengths = cached_datasets[name]
+    dataset = Dataset(root_dir, download=True, **kwargs)
+
+    images = dataset.data.numpy() if torch.is_tensor(dataset.data) else np.asarray(dataset.data)
+    if images.ndim == 3:
+        images = images[:, None]  # [N, H, W]
+    elif images.shape[-1] == 3:
+        images = images.transpose(0, 3, 1, 2)  # [N, H, W, C]
+    labels = dataset.labels if hasattr(dataset, "labels") else dataset.targets
+    labels = np.asarray(labels, dtype=np.int64)
+
+    # the same permutation as random_split on the dataset
+    splits = random_split(range(len(labels)), lengths, generator=torch.Generator().manual_seed(42))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    for split, subset in zip(["train", "val"], splits):
+        idx = np.asarray(subset.indices)
+        save_npy(f"{path}_{split}_images.npy", images[idx])
+        # the labels are written last, they mark the split as complete
+        save_npy(f"{path}_{split}_labels.npy", labels[idx])
+
+    return path
+
+
+def get_cached_data(name, batch_size, root_dir):
+    path = cache_dataset(name, root_dir)
+    pin_memory = torch.cuda.is_available()
+    train_loader, val_loader = [
+        DataLoader(
+            CachedImages(f"{path}_{split}"),
+            batch_size=batch_size,
+            collate_fn=collate_batch,
+            pin_memory=pin_memory,
+        )
+        for split in ["train", "val"]
+    ]
+    return train_loader, val_loader
+
+
+def get_data(name, batch_size=32, root_dir = "../data/", cached=False):
+
+    # the small datasets are served as whole batches from a uint8 cache
+    if cached and name in cached_datasets:
+        return get_cached_data(name, batch_size, root_dir)
 
     if name == "mnist":
         dataset = MNIST(
@@ -118,6 +308,20 @@ def get_data(name, batch_size=32, root_dir = "../data/"):
             val, batch_size=batch_size, num_workers=8, pin_memory=True
         )
 
+    elif name == "celeba" and cached:
+        # whole batches from the packed store of the resized images, that is
+        # written next to the images in root_dir/celeba
+        train_set, val_set = [
+            CelebA(root_dir, split=split, packed_size=(64, 64))
+            for split in ["train", "test"]
+        ]
+        train_loader = DataLoader(
+            train_set, batch_size=batch_size, collate_fn=collate_batch, pin_memory=True
+        )
+        val_loader = DataLoader(
+            val_set, batch_size=batch_size, collate_fn=collate_batch, pin_memory=True
+        )
+
     elif name == "celeba":
         h = w = 64
         tp = transforms.Compose([transforms.Resize((h, w)), transforms.ToTensor()])
@@ -151,6 +355,38 @@ def get_data(name, batch_size=32, root_dir = "../data/"):
     return train_loader, val_loader
 
 
+class TensorBatchLoader:
+    """In memory replacement of DataLoader(TensorDataset(*tensors)), that yields
+    contiguous slices of the tensors (of a permutation of them, if shuffled),
+    so there is no per item work"""
+
+    def __init__(self, *tensors, batch_size=1, shuffle=False, drop_last=False, generator=None):
+        assert all(len(t) == len(tensors[0]) for t in tensors)
+        self.tensors = tensors
+        self.dataset = TensorDataset(*tensors)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+
+    def __len__(self):
+        n = len(self.dataset)
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        tensors = self.tensors
+        if self.shuffle:
+            # one gather per epoch, the batches are slices of the permutation
+            perm = torch.randperm(len(self.dataset), generator=self.generator)
+            tensors = [t[perm.to(t.device)] for t in tensors]
+
+        for i in range(len(self)):
+            start = i * self.batch_size
+            yield [t[start : start + self.batch_size] for t in tensors]
+
+
 def generate_latent_grid(x, n_points_axis=50, batch_size=1):
 
     x_min = x[:, 0].min()
@@ -173,9 +409,7 @@ def generate_latent_grid(x, n_points_axis=50, batch_size=1):
     Z_grid_test = np.hstack((xg, yg))
     Z_grid_test = torch.from_numpy(Z_grid_test)
 
-    z_grid_loader = DataLoader(
-        TensorDataset(Z_grid_test), batch_size=batch_size, pin_memory=True
-    )
+    z_grid_loader = TensorBatchLoader(Z_grid_test, batch_size=batch_size)
 
     return xg_mesh, yg_mesh, z_grid_loader
 
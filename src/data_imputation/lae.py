@@ -8,7 +8,9 @@ from data import get_data
 from models import get_encoder, get_decoder
 from torch.nn.utils import parameters_to_vector, vector_to_parameters
 from copy import deepcopy
-from hessian import laplace
+from laplace import laplace
+from laplace.laplace import init_prior_precision, prior_precision_vector
+from laplace.samplebank import sample_bank_header, sample_from_bank
 from helpers import BaseImputation
 
 laplace_methods = {
@@ -49,14 +51,34 @@ class LAEImputation(BaseImputation):
         laplace = laplace_methods[config["approximation"]]()
         hessian_scale = torch.tensor(float(config["hessian_scale"]))
 
+        # newer checkpoints store the prior precision with the hessian
         h = torch.load(f"../../weights/{path}/hessian.pth")
         prior_prec = config["prior_precision"]
-
-        sigma_q = laplace.posterior_scale(h, hessian_scale, prior_prec)
-
-        # draw samples from the nn (sample nn)
-        mu_q = parameters_to_vector(self.net.parameters()).unsqueeze(1)
-        self.samples = laplace.sample(mu_q, sigma_q, n_samples=config["test_samples"])
+        if isinstance(h, dict):
+            h, prior_prec = h["hessian"], h["prior_prec"]
+        prior_prec = init_prior_precision(self.net, prior_prec)
+
+        def sample():
+            sigma_q = laplace.posterior_scale(
+                h, hessian_scale, prior_precision_vector(prior_prec, self.net)
+            )
+
+            # draw samples from the nn (sample nn)
+            mu_q = parameters_to_vector(self.net.parameters()).unsqueeze(1)
+            return laplace.sample(mu_q, sigma_q, n_samples=config["test_samples"])
+
+        # the samples are shared with the evaluation through the sample bank
+        header = sample_bank_header(
+            self.net,
+            h,
+            prior_prec,
+            hessian_scale,
+            config["seed"] if "seed" in config else 0,
+            config["test_samples"],
+        )
+        self.samples = sample_from_bank(
+            f"../../weights/{path}/samples.bank", header, sample
+        ).to(device)
 
     def forward_pass(self, x):
 
@@ -4,7 +4,9 @@ sys.path.append("../")
 
 import torch
 from data import get_data
+from models import get_encoder
 from utils import load_laplace
+from trainer_lae_posthoc import get_flatten_decoder, get_laplace, get_model
 from helpers import BaseImputation
 
 
@@ -16,7 +18,9 @@ class LAEPosthocImputation(BaseImputation):
         self.n_samples = 10
 
         path = f"{config['path']}"
-        self.la = load_laplace(f"../../weights/{path}/ae.pkl")
+        encoder = get_encoder(config, config["latent_size"]).eval().to(device)
+        net = get_model(encoder, get_flatten_decoder(config, config["latent_size"]))
+        self.la = load_laplace(f"../../weights/{path}/ae.ckpt", get_laplace(net, config))
 
     def forward_pass(self, xi):
 
@@ -113,6 +117,9 @@ if __name__ == "__main__":
     config = {
         "dataset": "mnist", 
         "path": path,
+        "no_conv": True,
+        "latent_size": 2,
+        "approximation": "diag",
         "test_samples": 100,
     }
 
@@ -45,6 +45,9 @@ class MseHessianCalculator(HessianCalculator):
         self.context = DiagGGNMC if self.stochastic else DiagGGNExact
         self.lossfunc = torch.nn.MSELoss(reduction="sum")
         self.lossfunc = extend(self.lossfunc)
+        # the loss only takes [b, D] inputs, and backpack only backpropagates
+        # through modules, so the prediction is flattened by one
+        self.flatten = extend(torch.nn.Flatten())
         if model is not None:
             self.model = extend(model)
 
@@ -57,7 +60,7 @@ class MseHessianCalculator(HessianCalculator):
     def __call__(self, net, feature_maps, X, **kwargs):
         b = X.shape[0]
         y_hat = net(X)
-        loss = self.lossfunc(y_hat.view(b, -1), X.view(b, -1))
+        loss = self.lossfunc(self.flatten(y_hat), X.view(b, -1))
         with backpack(self.context()):
             loss.backward()
         loss = loss.detach()
@@ -67,7 +70,7 @@ class MseHessianCalculator(HessianCalculator):
         b = X.shape[0]
 
         f = self.model(X)
-        loss = self.lossfunc(f.view(b, -1), y.view(b, -1))
+        loss = self.lossfunc(self.flatten(f), y.view(b, -1))
         with backpack(self.context()):
             loss.backward()
         dggn = self._get_diag_ggn(self.model)
@@ -91,6 +94,9 @@ class CrossEntropyHessianCalculator(HessianCalculator):
         self.context = DiagGGNMC if self.stochastic else DiagGGNExact
         self.lossfunc = torch.nn.CrossEntropyLoss(reduction="sum")
         self.lossfunc = extend(self.lossfunc)
+        # the loss only takes [b, D] inputs, and backpack only backpropagates
+        # through modules, so the prediction is flattened by one
+        self.flatten = extend(torch.nn.Flatten())
         if model is not None:
             self.model = extend(model)
 
@@ -103,7 +109,7 @@ class CrossEntropyHessianCalculator(HessianCalculator):
     def __call__(self, net, feature_maps, X, **kwargs):
         b = X.shape[0]
         y_hat = net(X)
-        loss = self.lossfunc(y_hat.view(b, -1), X.view(b, -1))
+        loss = self.lossfunc(self.flatten(y_hat), X.view(b, -1))
         with backpack(self.context()):
             loss.backward()
         loss = loss.detach()
@@ -113,7 +119,7 @@ class CrossEntropyHessianCalculator(HessianCalculator):
         b = X.shape[0]
 
         f = self.model(X)
-        loss = self.lossfunc(f.view(b, -1), y.view(b, -1))
+        loss = self.lossfunc(self.flatten(f), y.view(b, -1))
         with backpack(self.context()):
             loss.backward()
         dggn = self._get_diag_ggn(self.model)
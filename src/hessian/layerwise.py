@@ -1,9 +1,13 @@
+import json
 from abc import abstractmethod
+from contextlib import contextmanager, nullcontext
 
 import torch
 
 import sys
 import torch.nn.functional as F
+from torch.func import functional_call, jvp, vjp, vmap
+from torch.nn.modules.utils import _pair
 
 sys.path.append("../stochman")
 from stochman import nnj
@@ -44,6 +48,364 @@ def diag_structure(curr_method):
     return diag_inp_m, diag_out_m, diag_inp_h, diag_out_h
 
 
+def block_to_full(blocks):
+    """[B, P, K, K] blocks -> dense [B, K * P, K * P] matrix, where the flat
+    output index is k * P + p as in pred.reshape(B, -1)"""
+    b, p, k, _ = blocks.shape
+    full = torch.diag_embed(blocks.permute(0, 2, 3, 1))  # [B, K, K, P, P]
+    return full.movedim(3, 2).reshape(b, k * p, k * p)
+
+
+def block_to_diag(blocks):
+    """[B, P, K, K] blocks -> diagonal [B, K * P]"""
+    b = blocks.shape[0]
+    return torch.diagonal(blocks, dim1=2, dim2=3).movedim(1, 2).reshape(b, -1)
+
+
+def upsample_scale(layer):
+    """integer scale factor of a nearest Upsample layer, None otherwise"""
+    scale = layer.scale_factor
+    if layer.mode != "nearest" or layer.size is not None or scale is None:
+        return None
+    scale = tuple(scale) if isinstance(scale, (tuple, list)) else (scale, scale)
+    if any(float(s) != int(s) for s in scale):
+        return None
+    return tuple(int(s) for s in scale)
+
+
+def maxpool_indices(layer, x, val):
+    """flat input index [B, C * H2 * W2] that each output of a MaxPool2d copies"""
+    b, c1, h1, w1 = x.shape
+    offset = torch.arange(c1, device=x.device).reshape(1, c1, 1, 1) * (h1 * w1)
+    return (layer.idx + offset).reshape(b, -1)
+
+
+def is_overlapping(layer):
+    """whether the pooling windows of a MaxPool2d layer share inputs"""
+    kernel = _pair(layer.kernel_size)
+    stride = _pair(layer.stride if layer.stride is not None else layer.kernel_size)
+    dilation = _pair(layer.dilation)
+    return any(s < d * (k - 1) + 1 for k, s, d in zip(kernel, stride, dilation))
+
+
+def jacobian_wrt_input_sandwich(layer, x, val, tmp, diag_inp, diag_out):
+    """J^T tmp J w.r.t. the layer input. The jacobians of nearest Upsample
+    and MaxPool2d layers are 0/1 replication and selection matrices, so
+    these are sums over the replicas and scatter adds of the selected
+    inputs instead of dense products."""
+
+    if isinstance(layer, nnj.Upsample) and upsample_scale(layer) is not None:
+        return _upsample_sandwich(layer, x, tmp, diag_inp, diag_out)
+
+    if isinstance(layer, nnj.MaxPool2d):
+        return _maxpool_sandwich(layer, x, val, tmp, diag_inp, diag_out)
+
+    return layer._jacobian_wrt_input_sandwich(x, val, tmp, diag_inp, diag_out)
+
+
+def _upsample_sandwich(layer, x, tmp, diag_inp, diag_out):
+    b, c1, h1, w1 = x.shape
+    sh, sw = upsample_scale(layer)
+    n_inp = c1 * h1 * w1
+
+    # every input is replicated to a sh x sw patch of outputs
+    if diag_inp:
+        tmp = tmp.reshape(b, c1, h1, sh, w1, sw).sum(dim=(3, 5)).reshape(b, n_inp)
+        return tmp if diag_out else torch.diag_embed(tmp)
+
+    tmp = tmp.reshape(b, c1, h1, sh, w1, sw, c1, h1, sh, w1, sw)
+    tmp = tmp.sum(dim=(3, 5, 8, 10)).reshape(b, n_inp, n_inp)
+    return torch.diagonal(tmp, dim1=1, dim2=2) if diag_out else tmp
+
+
+def _maxpool_sandwich(layer, x, val, tmp, diag_inp, diag_out):
+    b = x.shape[0]
+    n_inp = x[0].numel()
+    idx = maxpool_indices(layer, x, val)  # [B, out]
+
+    # J^T diag(tmp) J is diagonal, every output selects a single input
+    if diag_inp:
+        tmp = torch.zeros(b, n_inp, device=x.device, dtype=tmp.dtype).scatter_add_(1, idx, tmp)
+        return tmp if diag_out else torch.diag_embed(tmp)
+
+    # windows that don't overlap select distinct inputs, so only the
+    # diagonal of tmp enters the diagonal of J^T tmp J
+    if diag_out and not is_overlapping(layer):
+        diag = torch.diagonal(tmp, dim1=1, dim2=2)
+        return torch.zeros(b, n_inp, device=x.device, dtype=tmp.dtype).scatter_add_(1, idx, diag)
+
+    Jt_tmp_J = torch.zeros(b, n_inp, n_inp, device=x.device, dtype=tmp.dtype)
+    batch = torch.arange(b, device=x.device).reshape(b, 1, 1)
+    Jt_tmp_J.index_put_((batch, idx.unsqueeze(2), idx.unsqueeze(1)), tmp, accumulate=True)
+    return torch.diagonal(Jt_tmp_J, dim1=1, dim2=2) if diag_out else Jt_tmp_J
+
+
+def block_jacobian_wrt_weight_sandwich(layer, x, val, blocks, diag_out):
+
+    # non parametric layer
+    if len(list(layer.parameters())) == 0:
+        return None
+
+    # each weight only feeds outputs of one class, and the blocks only couple
+    # different classes, so just the block diagonals enter the diagonal
+    if diag_out:
+        return layer._jacobian_wrt_weight_sandwich(
+            x, val, block_to_diag(blocks), True, True
+        )
+
+    return layer._jacobian_wrt_weight_sandwich(
+        x, val, block_to_full(blocks), False, False
+    )
+
+
+def block_jacobian_wrt_input_sandwich(layer, x, val, blocks, diag_out):
+
+    # the flattened order is unchanged, so the blocks can be passed on
+    if isinstance(layer, (nnj.Reshape, nnj.Flatten)):
+        return blocks
+
+    if isinstance(layer, nnj.Linear):
+        b, p, k, _ = blocks.shape
+        weight = layer.weight.reshape(k, p, -1)  # [K, P, in]
+        if diag_out:
+            return torch.einsum("kpm,bpkl,lpm->bm", weight, blocks, weight)
+        return torch.einsum("kpm,bpkl,lpn->bmn", weight, blocks, weight)
+
+    if isinstance(layer, nnj.Conv2d) and layer.groups == 1:
+        return _conv2d_block_sandwich(layer, x, val, blocks, diag_out)
+
+    # the channel k * C + c is replicated the same way for every k, so the
+    # blocks of the replicas just sum up
+    if isinstance(layer, nnj.Upsample) and upsample_scale(layer) is not None:
+        b, p, k, _ = blocks.shape
+        c1, h1, w1 = x.shape[1] // k, x.shape[2], x.shape[3]
+        sh, sw = upsample_scale(layer)
+        blocks = blocks.reshape(b, c1, h1, sh, w1, sw, k, k).sum(dim=(3, 5))
+        blocks = blocks.reshape(b, c1 * h1 * w1, k, k)
+        return block_to_diag(blocks) if diag_out else blocks
+
+    # fall back to the dense output hessian
+    return layer._jacobian_wrt_input_sandwich(
+        x, val, block_to_full(blocks), False, diag_out
+    )
+
+
+def _conv2d_block_sandwich(layer, x, val, blocks, diag_out):
+    b, c1, h1, w1 = x.shape
+    c2, h2, w2 = val.shape[1:]
+    k = blocks.shape[-1]
+    n_inp = c1 * h1 * w1
+
+    # output channel k * C + c at location s belongs to block (c, s)
+    weight = layer.weight.reshape(k, c2 // k, -1)  # [K, C, c1 * kh * kw]
+    blocks = blocks.reshape(b, c2 // k, h2 * w2, k, k)
+
+    # input index of every element in the receptive fields, padding is
+    # mapped to an extra index that is dropped at the end
+    idx = torch.arange(1, n_inp + 1, device=x.device, dtype=x.dtype)
+    idx = F.unfold(
+        idx.reshape(1, c1, h1, w1),
+        layer.kernel_size,
+        dilation=layer.dilation,
+        padding=layer.padding,
+        stride=layer.stride,
+    )
+    idx = idx[0].T.round().long() - 1  # [S, c1 * kh * kw]
+    idx[idx < 0] = n_inp
+
+    if diag_out:
+        Jt_tmp_J = torch.zeros(b, n_inp + 1, device=x.device)
+    else:
+        Jt_tmp_J = torch.zeros(b, (n_inp + 1) ** 2, device=x.device)
+        idx = (idx.unsqueeze(2) * (n_inp + 1) + idx.unsqueeze(1)).reshape(-1)
+
+    # one sample at a time to bound the memory of the receptive field blocks
+    for i in range(b):
+        if diag_out:
+            patch = torch.einsum("kcm,cskl,lcm->sm", weight, blocks[i], weight)
+        else:
+            patch = torch.einsum("kcm,cskl,lcn->smn", weight, blocks[i], weight)
+        Jt_tmp_J[i].index_add_(0, idx.reshape(-1), patch.reshape(-1))
+
+    if diag_out:
+        return Jt_tmp_J[:, :n_inp]
+    return Jt_tmp_J.reshape(b, n_inp + 1, n_inp + 1)[:, :n_inp, :n_inp]
+
+
+def check_kfac_layers(net):
+    """kfac needs the layer input patches, so it supports Linear and Conv2d
+    (groups=1) layers only, any other layer with parameters is rejected"""
+    for k, layer in enumerate(net):
+        if len(list(layer.parameters())) == 0:
+            continue
+        if isinstance(layer, nnj.Linear) or (isinstance(layer, nnj.Conv2d) and layer.groups == 1):
+            continue
+        raise ValueError(
+            f"kfac supports Linear and Conv2d (groups=1) layers, layer {k} is a {type(layer).__name__}"
+        )
+
+
+def layer_input_patches(layer, x):
+    """[B, in, S] inputs of the weight of a Linear/Conv2d layer at each of the S
+    output positions, with a row of ones for the bias"""
+    if isinstance(layer, nnj.Linear):
+        a = x.unsqueeze(2)
+    else:
+        a = F.unfold(
+            x,
+            layer.kernel_size,
+            dilation=layer.dilation,
+            padding=layer.padding,
+            stride=layer.stride,
+        )  # [B, c1 * kh * kw, S]
+
+    if layer.bias is not None:
+        a = torch.cat([a, torch.ones_like(a[:, :1])], dim=1)
+    return a
+
+
+def sample_gaussian_output(pred):
+    """v with E[v v^T] = I, the output hessian of the mse"""
+    return torch.randn_like(pred)
+
+
+def sample_softmax_output(pred):
+    """v = onehot(c) - p with c ~ softmax(pred) over dim 1, so that E[v v^T] =
+    diag(p) - p p^T is the output hessian of the cross entropy"""
+    prob = F.softmax(pred, dim=1)
+    c = torch.distributions.Categorical(probs=prob.movedim(1, -1)).sample()
+    return F.one_hot(c, pred.shape[1]).movedim(-1, 1).to(prob.dtype) - prob
+
+
+def kfac_factors(net, feature_maps, sample_output, n_samples=1, profile=None):
+    """Kronecker factors (A, G, bias) of the weight hessian of every parametric
+    layer, H ~ G (x) A. A is the covariance of the layer inputs (with a row of
+    ones for the bias) and G the covariance of the gradients w.r.t. the layer
+    outputs, backpropagated from n_samples vectors v = sample_output(pred)
+    with E[v v^T] the output hessian (Martens & Grosse), averaged over batch
+    and spatial positions. So one backward pass per sample instead of the
+    dense [B, D, D] sweep. feature_maps is the input followed by the outputs
+    of every layer."""
+    check_kfac_layers(net)
+    profile = profile or (lambda *args: nullcontext())
+    layers = [k for k, layer in enumerate(net) if len(list(layer.parameters())) > 0]
+
+    # the forward from the output of the first layer on, with a graph; the
+    # gradient w.r.t. the output of a layer is the same for any weights of it
+    outputs = [feature_maps[1].clone().requires_grad_()]
+    with torch.enable_grad():
+        for k in range(1, len(net)):
+            outputs.append(LayerForward(net[k])(outputs[-1]))
+
+    G = [0] * len(layers)
+    for _ in range(n_samples):
+        v = sample_output(outputs[-1].detach())
+        with profile(len(net) - 1, net[-1], "kfac", "backward", v):
+            grads = torch.autograd.grad(
+                outputs[-1], [outputs[k] for k in layers], v, retain_graph=True
+            )
+        for i, g in enumerate(grads):
+            g = g.reshape(g.shape[0], g.shape[1], -1)  # [B, out, S]
+            G[i] = G[i] + torch.einsum("bis,bjs->ij", g, g) / (g.shape[0] * g.shape[2] * n_samples)
+
+    H = []
+    for i, k in enumerate(layers):
+        with profile(k, net[k], "kfac", "weight", feature_maps[k]):
+            a = layer_input_patches(net[k], feature_maps[k])
+            A = torch.einsum("bms,bns->mn", a, a)
+        H.append((A, G[i].detach(), net[k].bias is not None))
+    return H
+
+
+def reset_peak_rss():
+    """resets the peak resident set size of the process and returns the
+    current one in MB, None where /proc doesn't support it (linux only)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return proc_status_mb("VmRSS")
+    except OSError:
+        return None
+
+
+def proc_status_mb(key):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(f"{key}:"):
+                return int(line.split()[1]) / 1024
+
+
+class SweepProfiler:
+    """Records the time, the peak memory and the shape of the incoming tmp of
+    every weight and input sandwich of the hessian sweeps. The peak memory is
+    the peak allocated cuda memory, or on cpu the peak resident set size of
+    the process above the one at the start of the sandwich (process wide, so
+    it includes other threads)"""
+
+    def __init__(self):
+        self.records = []
+        self.origin = time.time()
+
+    @contextmanager
+    def __call__(self, k, layer, method, sandwich, tmp):
+        cuda = tmp.is_cuda
+        if cuda:
+            torch.cuda.synchronize(tmp.device)
+            torch.cuda.reset_peak_memory_stats(tmp.device)
+        else:
+            rss = reset_peak_rss()
+        start = time.time()
+        yield
+        if cuda:
+            torch.cuda.synchronize(tmp.device)
+            peak_memory = torch.cuda.max_memory_allocated(tmp.device) / 2**20
+        else:
+            peak_memory = proc_status_mb("VmHWM") - rss if rss is not None else None
+        self.records.append(
+            {
+                "layer": k,
+                "type": type(layer).__name__,
+                "method": method,
+                "sandwich": sandwich,
+                "start_s": start - self.origin,
+                "time_s": time.time() - start,
+                "peak_memory_mb": peak_memory,
+                "tmp_shape": list(tmp.shape),
+            }
+        )
+
+    def clear(self):
+        self.records = []
+
+    def summary(self):
+        """total time and peak memory per layer and sandwich, e.g. for logging"""
+        summary = {}
+        for r in self.records:
+            name = f"hessian/{r['layer']}_{r['type']}/{r['sandwich']}"
+            summary[f"{name}_time_s"] = summary.get(f"{name}_time_s", 0) + r["time_s"]
+            if r["peak_memory_mb"] is not None:
+                summary[f"{name}_peak_mb"] = max(summary.get(f"{name}_peak_mb", 0), r["peak_memory_mb"])
+        return summary
+
+    def save_chrome_trace(self, path):
+        """the records as a chrome trace (chrome://tracing or perfetto)"""
+        events = [
+            {
+                "name": f"{r['layer']} {r['type']} {r['sandwich']}",
+                "cat": r["method"],
+                "ph": "X",
+                "ts": r["start_s"] * 1e6,
+                "dur": r["time_s"] * 1e6,
+                "pid": 0,
+                "tid": 0 if r["sandwich"] == "weight" else 1,
+                "args": {k: r[k] for k in ("method", "peak_memory_mb", "tmp_shape")},
+            }
+            for r in self.records
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
 class HessianCalculator:
     def __init__(self):
         super(HessianCalculator, self).__init__()
@@ -58,11 +420,120 @@ class HessianCalculator:
         raise NotImplementedError
 
 
+class LayerForward(torch.nn.Module):
+    """calls layer.forward, so the forward hooks of the layer do not fire"""
+
+    def __init__(self, layer):
+        super(LayerForward, self).__init__()
+        self.layer = layer
+
+    def forward(self, x):
+        return self.layer.forward(x)
+
+
+def chunked_exact_diag(net, feature_maps, output_size, chunk_size):
+    """Exact diagonal of the mse ggn, J^T J = sum_c (J^T e_c)^2 over chunks of
+    chunk_size output dimensions. The columns J^T e_c are backpropagated per
+    sample with vjps, so the memory peaks at [B, chunk_size, max(width, params)]
+    instead of the [B, D, D] backpropagated hessian."""
+    bs = feature_maps[0].shape[0]
+    layers = [LayerForward(layer) for layer in net]
+    params = [{n: p.detach() for n, p in layer.named_parameters()} for layer in layers]
+    H = [torch.zeros(sum(p.numel() for p in p_k.values()), device=feature_maps[0].device) for p_k in params]
+
+    for start in range(0, output_size, chunk_size):
+        cols = torch.arange(start, min(start + chunk_size, output_size), device=H[0].device)
+        V = torch.zeros(bs, len(cols), output_size, device=H[0].device)
+        V[:, torch.arange(len(cols)), cols] = 1
+        V = V.reshape(bs, len(cols), *feature_maps[-1].shape[1:])
+
+        for k in range(len(net) - 1, -1, -1):
+
+            def f(p_k, x_b):
+                return functional_call(layers[k], p_k, (x_b.unsqueeze(0),)).squeeze(0)
+
+            def vjp_sample(x_b, V_b):
+                _, vjp_fn = vjp(f, params[k], x_b)
+                return vmap(vjp_fn)(V_b)
+
+            g_k, V = vmap(vjp_sample)(feature_maps[k], V)
+            if len(g_k) > 0:
+                H[k] += torch.cat([g.pow(2).sum(dim=(0, 1)).flatten() for g in g_k.values()])
+
+    return torch.cat(H, dim=0)
+
+
+def split_like(v, params):
+    """[..., P] -> {name: [..., *p.shape]} in the order of params"""
+    sizes = [p.numel() for p in params.values()]
+    return {
+        n: v_n.reshape(*v.shape[:-1], *p.shape)
+        for (n, p), v_n in zip(params.items(), v.split(sizes, dim=-1))
+    }
+
+
+def ggn_products(net, feature_maps, k, V):
+    """G V [P_k, m] for the mse ggn G = J^T J of the parameters of layer k
+    and V [P_k, m]. J V is pushed forward with jvps and pulled back with a
+    vjp, so only the [m, B, D] outputs and the [P_k, m] products are held."""
+    layers = [LayerForward(layer) for layer in net]
+    params = {n: p.detach() for n, p in layers[k].named_parameters()}
+
+    def f(p_k):
+        h = functional_call(layers[k], p_k, (feature_maps[k],))
+        for layer in layers[k + 1 :]:
+            h = layer(h)
+        return h
+
+    _, vjp_fn = vjp(f, params)
+
+    def product(v):
+        _, Jv = jvp(f, (params,), (split_like(v, params),))
+        (JtJv,) = vjp_fn(Jv)
+        return torch.cat([g.flatten() for g in JtJv.values()])
+
+    return vmap(product)(V.T).T
+
+
+def lowrank_ggn(net, feature_maps, k, diag, rank, n_oversamples=10, n_power_iter=1):
+    """Diagonal plus rank k factor (d, U) of the mse ggn of layer k, G ~
+    diag(d) + U U^T. U spans the top eigenvectors of G, found with a
+    randomized range finder (Halko et al.) on ggn-vector products, so the
+    dense [P_k, P_k] block is never formed. d is what U leaves of the exact
+    diagonal diag [P_k] of G."""
+    n_params = len(diag)
+    Q = torch.randn(n_params, min(rank + n_oversamples, n_params), device=diag.device)
+    for _ in range(n_power_iter + 1):
+        Q, _ = torch.linalg.qr(ggn_products(net, feature_maps, k, Q))
+
+    # G restricted to the range, Q^T G Q, is only [m, m]
+    B = Q.T @ ggn_products(net, feature_maps, k, Q)
+    eigvals, eigvecs = torch.linalg.eigh((B + B.T) / 2)
+    eigvals = eigvals[-rank:].clamp(min=0)
+    U = (Q @ eigvecs[:, -rank:]) * eigvals.sqrt()
+
+    d = (diag - (U**2).sum(dim=1)).clamp(min=0)
+    return d, F.pad(U, (0, rank - U.shape[1]))
+
+
 class MseHessianCalculator(HessianCalculator):
-    def __init__(self, method):
+    def __init__(self, method, memory_budget=None, profile=False, rank=10, mc_samples=1):
         super(MseHessianCalculator, self).__init__()
 
-        self.method = method  # block, exact, approx, mix
+        self.method = method  # block, exact, approx, mix, kfac, lowrank
+        # bytes, bounds the memory of the exact (and lowrank) method by chunking the outputs
+        self.memory_budget = memory_budget
+        # of the per layer factor of the lowrank method
+        self.rank = rank
+        # backward passes of the kfac method
+        self.mc_samples = mc_samples
+        # records every sandwich of the sweeps until it is cleared
+        self.profiler = SweepProfiler() if profile else None
+
+    def profile(self, k, layer, method, sandwich, tmp):
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler(k, layer, method, sandwich, tmp)
 
     def __call__(self, net, feature_maps, x, *args, **kwargs):
         
@@ -74,6 +545,34 @@ class MseHessianCalculator(HessianCalculator):
 
         feature_maps = [x] + feature_maps
 
+        if self.method == "kfac":
+            return kfac_factors(
+                net, feature_maps, sample_gaussian_output, self.mc_samples, self.profile
+            )
+
+        if self.method == "lowrank" or (self.method == "exact" and self.memory_budget is not None):
+            if self.memory_budget is None:
+                chunk_size = output_size
+            else:
+                width = max(
+                    [f[0].numel() for f in feature_maps]
+                    + [sum(p.numel() for p in layer.parameters()) for layer in net]
+                )
+                chunk_size = max(1, int(self.memory_budget // (bs * width * x.element_size())))
+            with torch.no_grad():
+                diag = chunked_exact_diag(net, feature_maps, output_size, chunk_size)
+                if self.method == "exact":
+                    return diag
+
+                # per layer (d, U) from ggn-vector products of the layer
+                sizes = [sum(p.numel() for p in layer.parameters()) for layer in net]
+                layers = [k for k, n in enumerate(sizes) if n > 0]
+                H = []
+                for k, diag_k in zip(layers, diag.split([sizes[k] for k in layers])):
+                    with self.profile(k, net[k], self.method, "weight", feature_maps[k + 1]):
+                        H.append(lowrank_ggn(net, feature_maps, k, diag_k, self.rank))
+                return H
+
         # if we use diagonal approximation or first layer is flatten
         tmp = torch.ones(output_size, device=x.device)  # [HWC]
         if self.method in ("block", "exact"):
@@ -86,8 +585,6 @@ class MseHessianCalculator(HessianCalculator):
         curr_method = "approx" if self.method == "mix" else self.method
         diag_inp_m, diag_out_m, diag_inp_h, diag_out_h = diag_structure(curr_method)
 
-        t1 = 0
-        t2 = 0
         H = []
         with torch.no_grad():
             for k in range(len(net) - 1, -1, -1):
@@ -103,32 +600,31 @@ class MseHessianCalculator(HessianCalculator):
                     )
 
                 # jacobian w.r.t weight
-                t = time.time()
-                h_k = net[k]._jacobian_wrt_weight_sandwich(
-                    feature_maps[k],
-                    feature_maps[k + 1],
-                    tmp,
-                    diag_inp_m,
-                    diag_out_m,
-                )
-                if h_k is not None:
-                    H = [h_k.sum(dim=0)] + H
-                t1 += time.time() - t
+                with self.profile(k, net[k], curr_method, "weight", tmp):
+                    h_k = net[k]._jacobian_wrt_weight_sandwich(
+                        feature_maps[k],
+                        feature_maps[k + 1],
+                        tmp,
+                        diag_inp_m,
+                        diag_out_m,
+                    )
+                    if h_k is not None:
+                        H = [h_k.sum(dim=0)] + H
 
                 # If we're in the last (first) layer, then skip the input jacobian
                 if k == 0:
                     break
 
                 # jacobian w.r.t input
-                t = time.time()
-                tmp = net[k]._jacobian_wrt_input_sandwich(
-                    feature_maps[k],
-                    feature_maps[k + 1],
-                    tmp,
-                    diag_inp_h,
-                    diag_out_h,
-                )
-                t2 += time.time() - t
+                with self.profile(k, net[k], curr_method, "input", tmp):
+                    tmp = jacobian_wrt_input_sandwich(
+                        net[k],
+                        feature_maps[k],
+                        feature_maps[k + 1],
+                        tmp,
+                        diag_inp_h,
+                        diag_out_h,
+                    )
 
         if self.method == "block":
             H = [H_layer for H_layer in H]
@@ -139,10 +635,12 @@ class MseHessianCalculator(HessianCalculator):
 
 
 class CrossEntropyHessianCalculator(HessianCalculator):
-    def __init__(self, method):
+    def __init__(self, method, mc_samples=1):
         super(CrossEntropyHessianCalculator, self).__init__()
 
-        self.method = method  # block, exact, approx, mix
+        self.method = method  # block, exact, approx, mix, kfac
+        # backward passes of the kfac method
+        self.mc_samples = mc_samples
 
     def __call__(self, net, feature_maps, x, *args, **kwargs):
         pred = feature_maps[-1]
@@ -158,23 +656,18 @@ class CrossEntropyHessianCalculator(HessianCalculator):
 
         feature_maps = [x] + feature_maps
 
+        if self.method == "kfac":
+            return kfac_factors(net, feature_maps, sample_softmax_output, self.mc_samples)
+
         # if we use diagonal approximation or first layer is flatten
 
         prob = F.softmax(pred, dim=1)  # [B, Classes, C, H, W]
         prob = prob.reshape(bs, classes, output_size)  # [B, Classes, CHW]
         if self.method in ("block", "exact"):
-            prob = prob.movedim(1, 2).reshape(bs, classes * output_size)
-            tmp = torch.zeros(
-                bs, classes * output_size, classes * output_size, device=x.device
-            )
-            for b in range(bs):
-                blocks = torch.chunk(prob[b], output_size)
-                blocks = [
-                    torch.diag_embed(block, dim1=-1, dim2=-2)
-                    - torch.einsum("c,d->cd", block, block)
-                    for block in blocks
-                ]
-                tmp[b] = torch.block_diag(*blocks)
+            # one [Classes, Classes] block per output position, the dense
+            # [B, Classes * CHW, Classes * CHW] matrix is never materialized
+            prob = prob.movedim(1, 2)  # [B, CHW, Classes]
+            tmp = torch.diag_embed(prob) - torch.einsum("bpc,bpd->bpcd", prob, prob)
 
         elif self.method in ("approx", "mix"):
             prob = prob.reshape(bs, classes * output_size)
@@ -205,13 +698,18 @@ class CrossEntropyHessianCalculator(HessianCalculator):
                     )
 
                 # jacobian w.r.t weight
-                h_k = net[k]._jacobian_wrt_weight_sandwich(
-                    feature_maps[k],
-                    feature_maps[k + 1],
-                    tmp,
-                    diag_inp_m,
-                    diag_out_m,
-                )
+                if tmp.ndim == 4:
+                    h_k = block_jacobian_wrt_weight_sandwich(
+                        net[k], feature_maps[k], feature_maps[k + 1], tmp, diag_out_m
+                    )
+                else:
+                    h_k = net[k]._jacobian_wrt_weight_sandwich(
+                        feature_maps[k],
+                        feature_maps[k + 1],
+                        tmp,
+                        diag_inp_m,
+                        diag_out_m,
+                    )
                 if h_k is not None:
                     H = [h_k.sum(dim=0)] + H
 
@@ -220,13 +718,19 @@ class CrossEntropyHessianCalculator(HessianCalculator):
                     break
 
                 # jacobian w.r.t input
-                tmp = net[k]._jacobian_wrt_input_sandwich(
-                    feature_maps[k],
-                    feature_maps[k + 1],
-                    tmp,
-                    diag_inp_h,
-                    diag_out_h,
-                )
+                if tmp.ndim == 4:
+                    tmp = block_jacobian_wrt_input_sandwich(
+                        net[k], feature_maps[k], feature_maps[k + 1], tmp, diag_out_h
+                    )
+                else:
+                    tmp = jacobian_wrt_input_sandwich(
+                        net[k],
+                        feature_maps[k],
+                        feature_maps[k + 1],
+                        tmp,
+                        diag_inp_h,
+                        diag_out_h,
+                    )
 
         if self.method == "block":
             H = [H_layer for H_layer in H]
@@ -1,10 +1,7 @@
 from abc import abstractmethod
 
 import torch
-from asdfghjkl import batch_gradient
-
-# from laplace.curvature.asdl import _get_batch_grad
-import time
+from torch.func import functional_call, jacrev, vmap
 
 
 class HessianCalculator:
@@ -28,14 +25,15 @@ class HessianCalculator:
 
 
 class MseHessianCalculator(HessianCalculator):
-    def __init__(self, hessian_structure):
+    def __init__(self, hessian_structure, chunk_size=None):
         super(MseHessianCalculator, self).__init__()
         self.hessian_structure = hessian_structure
+        self.chunk_size = chunk_size
 
     def compute_batch(self, model, output_size, x, *args, **kwargs):
         x = x.to(self.device)
 
-        Js, f = jacobians(x, model, output_size=output_size)
+        Js, f = jacobians(x, model, output_size=output_size, chunk_size=self.chunk_size)
         if self.hessian_structure == "diag":
             Hs = torch.einsum("nij,nij->nj", Js, Js)
         elif self.hessian_structure == "full":
@@ -46,53 +44,36 @@ class MseHessianCalculator(HessianCalculator):
         return Hs.sum(0)
 
 
-def jacobians(x, model, output_size=784):
+def jacobians(x, model, output_size=784, chunk_size=None):
     """Compute Jacobians \\(\\nabla_\\theta f(x;\\theta)\\)
        at current parameter \\(\\theta\\)
-    using asdfghjkl's gradient per output dimension.
+    using per sample reverse mode jacobians, vectorized over the batch
+    and over the output dimensions.
     Parameters
     ----------
     x : torch.Tensor
         input data `(batch, input_shape)` on compatible device with
         model.
+    chunk_size : int
+        number of output dimensions per vectorized backward pass, bounds
+        the peak memory to `(batch, chunk_size, parameters)`. All outputs
+        at once if None.
     Returns
     -------
     Js : torch.Tensor
-        Jacobians `(batch, parameters, outputs)`
+        Jacobians `(batch, outputs, parameters)`
     f : torch.Tensor
         output function `(batch, outputs)`
     """
-    jacobians = list()
-    f = None
-    for i in range(output_size):
-
-        def loss_fn(outputs, targets):
-            return outputs[:, i].sum()
-
-        f = batch_gradient(model, loss_fn, x, None).detach()
-        jacobian_i = _get_batch_grad(model)
-
-        jacobians.append(jacobian_i)
-    jacobians = torch.stack(jacobians, dim=1)
-    return jacobians, f
-
+    params = {name: p.detach() for name, p in model.named_parameters()}
 
-def _get_batch_grad(model):
-    batch_grads = list()
-    for module in model.modules():
-        if hasattr(module, "op_results"):
-            res = module.op_results["batch_grads"]
-            if "weight" in res:
-                batch_grads.append(_flatten_after_batch(res["weight"]))
-            if "bias" in res:
-                batch_grads.append(_flatten_after_batch(res["bias"]))
-            if len(set(res.keys()) - {"weight", "bias"}) > 0:
-                raise ValueError(f"Invalid parameter keys {res.keys()}")
-    return torch.cat(batch_grads, dim=1)
+    def f_single(params, x_i):
+        f_i = functional_call(model, params, (x_i.unsqueeze(0),))
+        return f_i.reshape(-1)[:output_size]
 
+    Js = vmap(jacrev(f_single, chunk_size=chunk_size), in_dims=(None, 0))(params, x)
+    Js = torch.cat([J.flatten(start_dim=2) for J in Js.values()], dim=2)
 
-def _flatten_after_batch(tensor: torch.Tensor):
-    if tensor.ndim == 1:
-        return tensor.unsqueeze(-1)
-    else:
-        return tensor.flatten(start_dim=1)
+    with torch.no_grad():
+        f = model(x).flatten(start_dim=1)[:, :output_size]
+    return Js, f
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 from abc import abstractmethod
 from torch.nn.utils import parameters_to_vector
 
@@ -11,6 +12,14 @@ class BaseLaplace:
     def sample(self, *args, **kwargs):
         pass
 
+    def merge_hessians(self, hessian, other, weight=1, other_weight=1):
+        return weight * hessian + other_weight * other
+
+    def eigenvalues(self, hessian):
+        """eigenvalues [P] of the hessian, the eigenvalues of each layer are
+        where the parameters of the layer are in parameters_to_vector"""
+        raise NotImplementedError
+
 
 class DiagLaplace(BaseLaplace):
     def sample(self, parameters, posterior_scale, n_samples=100):
@@ -24,6 +33,9 @@ class DiagLaplace(BaseLaplace):
         posterior_precision = hessian * scale + prior_prec
         return 1.0 / (posterior_precision.sqrt() + 1e-6)
 
+    def eigenvalues(self, hessian):
+        return hessian.clamp(min=0)
+
     def init_hessian(self, data_size, net, device):
 
         hessian = data_size * torch.ones_like(
@@ -65,9 +77,10 @@ class BlockLaplace(BaseLaplace):
 
     def posterior_scale(self, hessian, scale=1, prior_prec=1):
 
+        prior_prec = split_prior_precision(prior_prec, [h.shape[0] for h in hessian])
         posterior_precision = [
-            h * scale + torch.diag_embed(prior_prec * torch.ones(h.shape[0]))
-            for h in hessian
+            h * scale + torch.diag_embed(p * torch.ones(h.shape[0], device=h.device))
+            for h, p in zip(hessian, prior_prec)
         ]
         posterior_scale = [
             torch.cholesky_inverse(layer_post_prec)
@@ -75,6 +88,9 @@ class BlockLaplace(BaseLaplace):
         ]
         return posterior_scale
 
+    def eigenvalues(self, hessian):
+        return torch.cat([torch.linalg.eigvalsh(h).clamp(min=0) for h in hessian])
+
     def init_hessian(self, data_size, net, device):
 
         hessian = []
@@ -92,6 +108,9 @@ class BlockLaplace(BaseLaplace):
     def scale(self, h_s, b, data_size):
         return [h / b * data_size for h in h_s]
 
+    def merge_hessians(self, hessian, other, weight=1, other_weight=1):
+        return [weight * h + other_weight * o for h, o in zip(hessian, other)]
+
     def aveage_hessian_samples(self, hessian, constant):
         n_samples = len(hessian)
         n_layers = len(hessian[0])
@@ -111,3 +130,262 @@ class BlockLaplace(BaseLaplace):
             hessian_mean.append(tmp)
 
         return hessian_mean
+
+
+class LowRankLaplace(BaseLaplace):
+    """Per layer diagonal plus rank k hessian, H = diag(d) + U U^T"""
+
+    def __init__(self, rank=10):
+        super(LowRankLaplace, self).__init__()
+        self.rank = rank
+
+    def sample(self, parameters, posterior_scale, n_samples=100):
+        param_samples = []
+        for scale_diag, Q, coeff in posterior_scale:
+            # (I + W W^T)^(-1/2) eps with W = Q S R^T
+            eps = torch.randn(n_samples, len(scale_diag), device=scale_diag.device)
+            samples = eps + ((eps @ Q) * coeff) @ Q.T
+            param_samples.append(samples * scale_diag)
+
+        param_samples = torch.cat(param_samples, dim=1).to(parameters.device)
+        return parameters.view(1, -1) + param_samples
+
+    def posterior_scale(self, hessian, scale=1, prior_prec=1):
+        # the posterior precision A + V V^T = A^(1/2) (I + W W^T) A^(1/2) with
+        # A = scale * d + prior_prec and W = A^(-1/2) V, so that its inverse
+        # square root only needs the thin svd of W (Woodbury)
+        posterior_scale = []
+        prior_prec = split_prior_precision(prior_prec, [len(d) for d, _ in hessian])
+        for (d, U), p in zip(hessian, prior_prec):
+            scale_diag = 1.0 / (d * scale + p).sqrt()
+            W = U * scale**0.5 * scale_diag.unsqueeze(1)
+            Q, S, _ = torch.linalg.svd(W, full_matrices=False)
+            coeff = 1.0 / (1 + S**2).sqrt() - 1
+            posterior_scale.append((scale_diag, Q, coeff))
+        return posterior_scale
+
+    def eigenvalues(self, hessian):
+        """approximate eigenvalues of diag(d) + U U^T without the [P, P] matrix:
+        the k Ritz values in the span Q of U, which are exact for the top of
+        the spectrum that U carries, and for the other P - k the largest
+        entries of d, scaled to the trace of the complement. So the trace is
+        exact, and the spectrum too when d is constant (e.g. zero)."""
+        eigenvalues = []
+        for d, U in hessian:
+            Q, _ = torch.linalg.qr(U)
+            QDQ = Q.T @ (d.unsqueeze(1) * Q)
+            QU = Q.T @ U
+            top = torch.linalg.eigvalsh(QDQ + QU @ QU.T)
+
+            rest = d.sort(descending=True).values[: len(d) - len(top)]
+            rest = rest * (d.sum() - torch.trace(QDQ)).clamp(min=0) / rest.sum().clamp(min=1e-30)
+            eigenvalues.append(torch.cat([top, rest]).clamp(min=0))
+        return torch.cat(eigenvalues)
+
+    def init_hessian(self, data_size, net, device):
+
+        hessian = []
+        for layer in net:
+            # if parametric layer
+            if isinstance(layer, torch.nn.Conv2d) or isinstance(layer, torch.nn.Linear):
+                params = parameters_to_vector(layer.parameters())
+                n_params = len(params)
+                hessian.append(
+                    (
+                        data_size * torch.ones(n_params, device=device),
+                        torch.zeros(n_params, self.rank, device=device),
+                    )
+                )
+
+        return hessian
+
+    def scale(self, h_s, b, data_size):
+        # the layerwise lowrank method returns the (d, U) of each layer
+        return [(d / b * data_size, U * (data_size / b) ** 0.5) for d, U in h_s]
+
+    def average_hessian_samples(self, hessian, constant):
+        n_samples = len(hessian)
+        return [
+            self.merge(list(layer), [constant / n_samples] * n_samples)
+            for layer in zip(*hessian)
+        ]
+
+    def merge_hessians(self, hessian, other, weight=1, other_weight=1):
+        return [
+            self.merge([h, o], [weight, other_weight])
+            for h, o in zip(hessian, other)
+        ]
+
+    def merge(self, layer_hessians, weights):
+        """sum_i w_i (d_i + U_i U_i^T) truncated to rank k, the diagonal is kept exact"""
+        d = sum(w * d_i for w, (d_i, _) in zip(weights, layer_hessians))
+        U = torch.cat(
+            [w**0.5 * U_i for w, (_, U_i) in zip(weights, layer_hessians)], dim=1
+        )
+        Q, S, _ = torch.linalg.svd(U, full_matrices=False)
+        U_k = Q[:, : self.rank] * S[: self.rank]
+        d = d + (U**2).sum(dim=1) - (U_k**2).sum(dim=1)
+        return d.clamp(min=0), self._pad(U_k)
+
+    def _pad(self, U):
+        # layers with less than rank parameters
+        return F.pad(U, (0, self.rank - U.shape[1]))
+
+
+class KronLaplace(BaseLaplace):
+    """Per layer Kronecker factored hessian (A, G, bias), H = G (x) A with A
+    the input covariance and G the output hessian. With bias, the last
+    row/column of A is the bias. The flag travels with the factors, as a
+    layer with a bias and n inputs has the same factor shapes as one with
+    n + 1 inputs and no bias."""
+
+    def sample(self, parameters, posterior_scale, n_samples=100):
+        param_samples = []
+        for Q_G, Q_A, eig_scale, bias in posterior_scale:
+            eps = torch.randn(n_samples, *eig_scale.shape, device=eig_scale.device)
+            samples = Q_G @ (eps * eig_scale) @ Q_A.T  # [n_samples, out, in]
+
+            # back to the order of parameters_to_vector (weight, bias)
+            if bias:
+                samples = torch.cat(
+                    [samples[:, :, :-1].flatten(start_dim=1), samples[:, :, -1]], dim=1
+                )
+            param_samples.append(samples.flatten(start_dim=1))
+
+        param_samples = torch.cat(param_samples, dim=1).to(parameters.device)
+        return parameters.view(1, -1) + param_samples
+
+    def posterior_scale(self, hessian, scale=1, prior_prec=1):
+        # the eigenvectors of G (x) A are Q_G (x) Q_A with eigenvalues
+        # eig_G (x) eig_A, so only the two factors are decomposed
+        posterior_scale = []
+        prior_prec = split_prior_precision(
+            prior_prec, [A.shape[0] * G.shape[0] for A, G, _ in hessian]
+        )
+        for (A, G, bias), p in zip(hessian, prior_prec):
+            eig_A, Q_A = torch.linalg.eigh(A)
+            eig_G, Q_G = torch.linalg.eigh(G)
+            eig = scale * torch.outer(eig_G.clamp(min=0), eig_A.clamp(min=0))
+            # the eigenbasis is shared by the whole layer, so the prior
+            # precision of a layer is isotropic
+            if torch.is_tensor(p) and p.dim() > 0:
+                p = p.mean()
+            posterior_scale.append((Q_G, Q_A, 1.0 / (eig + p).sqrt(), bias))
+        return posterior_scale
+
+    def eigenvalues(self, hessian):
+        # the eigenvalues of G (x) A are all products of those of G and A
+        return torch.cat(
+            [
+                torch.outer(
+                    torch.linalg.eigvalsh(G).clamp(min=0), torch.linalg.eigvalsh(A).clamp(min=0)
+                ).flatten()
+                for A, G, _ in hessian
+            ]
+        )
+
+    def init_hessian(self, data_size, net, device):
+
+        hessian = []
+        for k, layer in enumerate(net):
+            # non parametric layer
+            if len(list(layer.parameters())) == 0:
+                continue
+            if not (
+                isinstance(layer, torch.nn.Linear)
+                or (isinstance(layer, torch.nn.Conv2d) and layer.groups == 1)
+            ):
+                raise ValueError(
+                    f"kfac supports Linear and Conv2d (groups=1) layers, layer {k} is a {type(layer).__name__}"
+                )
+
+            bias = layer.bias is not None
+            n_out = layer.weight.shape[0]
+            n_in = layer.weight[0].numel() + bias
+            hessian.append(
+                (
+                    data_size * torch.eye(n_in, device=device),
+                    torch.eye(n_out, device=device),
+                    bias,
+                )
+            )
+
+        return hessian
+
+    def scale(self, h_s, b, data_size):
+        # A is summed and G averaged over the batch
+        return [(A / b * data_size, G, bias) for A, G, bias in h_s]
+
+    def average_hessian_samples(self, hessian, constant):
+        n_samples = len(hessian)
+        return [
+            (
+                sum(A for A, _, _ in layer) / n_samples,
+                constant * sum(G for _, G, _ in layer) / n_samples,
+                layer[0][2],
+            )
+            for layer in zip(*hessian)
+        ]
+
+    def merge_hessians(self, hessian, other, weight=1, other_weight=1):
+        # A carries the scale, G is averaged with the weight of each A
+        merged = []
+        for (A, G, bias), (A_o, G_o, _) in zip(hessian, other):
+            w = weight * torch.trace(A)
+            w_o = other_weight * torch.trace(A_o)
+            merged.append(
+                (weight * A + other_weight * A_o, (w * G + w_o * G_o) / (w + w_o), bias)
+            )
+        return merged
+
+
+def parametric_layers(net):
+    """the index in the sequential net of every layer with parameters"""
+    return [i for i, layer in enumerate(net) if len(list(layer.parameters())) > 0]
+
+
+def init_prior_precision(net, prior_prec, layer_prior_prec=None, device="cpu"):
+    """The prior precision is either a scalar tensor shared by all parameters,
+    or a dict {layer index: scalar tensor} over the parametric layers of the
+    sequential net. prior_prec is a scalar or such a dict, layer_prior_prec
+    overrides the precision of some layers."""
+    layers = dict(prior_prec) if isinstance(prior_prec, dict) else {}
+    layers.update(layer_prior_prec or {})
+    if not layers:
+        return torch.tensor(float(prior_prec), device=device)
+
+    layers = {int(i): p for i, p in layers.items()}
+    return {
+        i: torch.tensor(float(layers[i] if i in layers else prior_prec), device=device)
+        for i in parametric_layers(net)
+    }
+
+
+def prior_precision_vector(prior_prec, net):
+    """the prior precision of every parameter [P], laid out like
+    parameters_to_vector, a scalar prior precision is returned as it is"""
+    if not isinstance(prior_prec, dict):
+        return prior_prec
+
+    return torch.cat(
+        [
+            prior_prec[i].expand(sum(p.numel() for p in net[i].parameters()))
+            for i in parametric_layers(net)
+        ]
+    )
+
+
+def prior_precision_values(prior_prec):
+    """plain floats of the prior precision, {layer index: float} for per layer
+    prior precisions"""
+    if isinstance(prior_prec, dict):
+        return {i: float(p) for i, p in prior_prec.items()}
+    return float(prior_prec)
+
+
+def split_prior_precision(prior_prec, sizes):
+    """the prior precision of each layer, given the number of parameters of
+    the layers, a scalar prior precision is shared by all layers"""
+    if torch.is_tensor(prior_prec) and prior_prec.dim() > 0:
+        return torch.split(prior_prec, sizes)
+    return [prior_prec] * len(sizes)
@@ -4,14 +4,28 @@ from backpack import extend
 from torch.nn.utils import parameters_to_vector, vector_to_parameters
 import torch
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from copy import deepcopy
 from torch.nn import functional as F
 
-from laplace.laplace import BlockLaplace, DiagLaplace
+from laplace.laplace import (
+    BlockLaplace,
+    DiagLaplace,
+    KronLaplace,
+    LowRankLaplace,
+    init_prior_precision,
+    prior_precision_values,
+    prior_precision_vector,
+)
 laplace_methods = {
     "block": BlockLaplace,
     "exact": DiagLaplace,
     "approx": DiagLaplace,
     "mix": DiagLaplace,
+    "lowrank": LowRankLaplace,
+    "kfac": KronLaplace,
 }
 
 
@@ -26,18 +40,35 @@ class OnlineLaplace:
         self.alpha = float(config["alpha"]) if "alpha" in config else 0
         self.net = net.to(device)
 
-        self.prior_prec = torch.tensor(float(config["prior_precision"])).to(device)
+        # a scalar, or one prior precision per parametric layer of the net,
+        # layer_prior_precision {layer index: precision} overrides single layers
+        self.prior_prec = init_prior_precision(
+            self.net,
+            config["prior_precision"],
+            config["layer_prior_precision"] if "layer_prior_precision" in config else None,
+            device,
+        )
         self.hessian_scale = torch.tensor(float(config["hessian_scale"])).to(device)
         self.dataset_size = dataset_size
         self.n_samples = config["train_samples"] if "train_samples" in config else 1
         self.one_hessian_per_sampling = config["one_hessian_per_sampling"] if "one_hessian_per_sampling" in config else False
         self.update_hessian = config["update_hessian"] if "update_hessian" in config else True
         self.hessian_memory_factor = float(config["hessian_memory_factor"]) if "hessian_memory_factor" in config else 0.999
+        self.vectorized_sampling = config["vectorized_sampling"] if "vectorized_sampling" in config else False
+        # in MB, chunks the output dimensions of the exact hessian
+        self.hessian_memory_budget = float(config["hessian_memory_budget"]) * 2**20 if "hessian_memory_budget" in config else None
+        # per layer time and memory of the hessian sweeps of the last step
+        self.profile_hessian = config["profile_hessian"] if "profile_hessian" in config else False
+        # computes the hessians in a background thread, while the next steps run,
+        # the hessian lags at most hessian_staleness steps behind the weights
+        self.async_hessian = config["async_hessian"] if "async_hessian" in config else False
+        self.hessian_staleness = int(config["hessian_staleness"]) if "hessian_staleness" in config else 1
 
         self.sigma_n = 1.0
         self.constant = 1.0 / (2 * self.sigma_n**2)
 
         if config["backend"] == "backpack":
+            assert not self.vectorized_sampling, "vectorized sampling requires the layer backend"
             self.HessianCalculator = bp.MseHessianCalculator()
             self.laplace = DiagLaplace()
             self.net = extend(self.net)
@@ -46,104 +77,163 @@ class OnlineLaplace:
 
             if register_forward_hook:
                 self.feature_maps = []
+                self.record_feature_maps = True
 
                 def fw_hook_get_latent(module, input, output):
-                    self.feature_maps.append(output.detach())
+                    if self.record_feature_maps:
+                        self.feature_maps.append(output.detach())
 
                 for k in range(len(self.net)):
                     self.net[k].register_forward_hook(fw_hook_get_latent)
 
-            self.HessianCalculator = lw.MseHessianCalculator(config["approximation"])
-            self.laplace = laplace_methods[config["approximation"]]()
+            approximation = config["approximation"]
+            rank = config["rank"] if "rank" in config else 10
+            self.HessianCalculator = lw.MseHessianCalculator(
+                approximation,
+                memory_budget=self.hessian_memory_budget,
+                profile=self.profile_hessian,
+                rank=rank,
+            )
+            if approximation == "lowrank":
+                self.laplace = LowRankLaplace(rank)
+            else:
+                self.laplace = laplace_methods[approximation]()
+
+        self.hessian_schedule = HessianSchedule(config)
+        self.hessian_change = None
 
+        # the posterior scale is cached until the hessian, the prior precision
+        # or the hessian scale change, every assignment to self.hessian is a version
+        self.hessian_version = 0
+        self.posterior_scale_key = None
         self.hessian = self.laplace.init_hessian(self.dataset_size, self.net, device)
 
+        if self.async_hessian:
+            assert config["backend"] != "backpack", "asynchronous hessians require the layer backend"
+            self.hessian_executor = ThreadPoolExecutor(max_workers=1)
+            self.pending_hessians = deque()
+            self.hessian_net, self.hessian_feature_maps = self.snapshot_net()
+            # with its own profiler, the records are handed to the main thread
+            # with the hessian, so no profiler is shared between the threads
+            self.background_calculator = deepcopy(self.HessianCalculator)
+
         # logging of time:
         self.timings = {
             "forward_nn": 0,
             "compute_hessian": 0,
+            "wait_hessian": 0,
             "entire_training_step": 0,
         }
 
     def elbo(self, x, train=True):
         self.timings["forward_nn"] = 0
         self.timings["compute_hessian"] = 0
+        self.timings["wait_hessian"] = 0
         self.timings["entire_training_step"] = time.time()
+        if train and self.hessian_profiler is not None:
+            self.hessian_profiler.clear()
         
-        sigma_q = self.laplace.posterior_scale(
-            self.hessian, self.hessian_scale, self.prior_prec
-        )
+        sigma_q = self.posterior_scale()
         mu_q = parameters_to_vector(self.net.parameters()).unsqueeze(1)
-        regularizer = weight_decay(mu_q, self.prior_prec)
+        regularizer = weight_decay(mu_q, prior_precision_vector(self.prior_prec, self.net))
 
         mse_running_sum = 0
         hessian = []
         x_recs = []
 
-        # draw samples from the nn (sample nn)
-        samples = self.laplace.sample(mu_q, sigma_q, self.n_samples)
-        for net_sample in samples:
+        # the number of steps that the hessian of this step stands for, 0 if the
+        # schedule skips it, and the rows of the batch that it is computed on
+        steps = self.hessian_schedule.step() if train else 0
+        x_h = self.hessian_schedule.subset(x) if steps > 0 else x
 
-            # replace the network parameters with the sampled parameters
-            vector_to_parameters(net_sample, self.net.parameters())
+        # the hessians are computed by the background thread instead
+        compute_hessian = steps > 0 and not self.async_hessian
 
-            # reset or init
-            self.feature_maps = []
+        # the feature maps of the sampled forward passes are reused if possible
+        reuse_feature_maps = (
+            compute_hessian
+            and x_h is x
+            and not self.vectorized_sampling
+            and not self.one_hessian_per_sampling
+        )
 
-            # predict with the sampled weights
-            start = time.time()
-            x_rec = self.net(x)
+        # draw samples from the nn (sample nn)
+        samples = self.laplace.sample(mu_q, sigma_q, self.n_samples)
+        if self.vectorized_sampling:
 
+            # predict with all sampled weights at once
+            start = time.time()
+            x_rec = self.sampled_forward(x, samples)
             self.timings["forward_nn"] += time.time() - start
 
-            # compute mse for sample net
-            mse_running_sum += F.mse_loss(x_rec.view(*x.shape), x)
+            # compute mse for sample nets
+            mse_running_sum += self.n_samples * F.mse_loss(
+                x_rec.view(self.n_samples, *x.shape),
+                x.expand(self.n_samples, *x.shape),
+            )
+            x_recs = list(x_rec)
+        else:
+            for net_sample in samples:
 
-            if (not self.one_hessian_per_sampling) and train:
-                # compute hessian for sample net
-                start = time.time()
+                # replace the network parameters with the sampled parameters
+                vector_to_parameters(net_sample, self.net.parameters())
 
-                # H = J^T J
-                h_s = self.HessianCalculator.__call__(self.net, self.feature_maps, x)
-                h_s = self.laplace.scale(h_s, x.shape[0], self.dataset_size)
+                # reset or init
+                self.feature_maps = []
 
-                self.timings["compute_hessian"] += time.time() - start
+                # predict with the sampled weights
+                start = time.time()
+                x_rec = self.net(x)
 
-                # append results
-                hessian.append(h_s)
-            x_recs.append(x_rec)
+                self.timings["forward_nn"] += time.time() - start
 
-        # reset the network parameters with the mean parameter (MAP estimate parameters)
-        vector_to_parameters(mu_q, self.net.parameters())
-        mse = mse_running_sum / self.n_samples
+                # compute mse for sample net
+                mse_running_sum += F.mse_loss(x_rec.view(*x.shape), x)
 
-        if self.one_hessian_per_sampling and train:
+                if reuse_feature_maps:
+                    # compute hessian for sample net
+                    start = time.time()
 
-            # reset or init
-            self.feature_maps = []
-            # predict with the sampled weights
-            x_rec = self.net(x)
-            # compute hessian for sample net
-            start = time.time()
+                    # H = J^T J
+                    h_s = self.HessianCalculator.__call__(self.net, self.feature_maps, x)
+                    h_s = self.laplace.scale(h_s, x.shape[0], self.dataset_size)
 
-            # H = J^T J
-            h_s = self.HessianCalculator.__call__(self.net, self.feature_maps, x)
-            hessian = [self.laplace.scale(h_s, x.shape[0], self.dataset_size)]
+                    self.timings["compute_hessian"] += time.time() - start
 
-            self.timings["compute_hessian"] += time.time() - start
+                    # append results
+                    hessian.append(h_s)
+                x_recs.append(x_rec)
+
+        mse = mse_running_sum / self.n_samples
+        weights = mu_q.T if self.one_hessian_per_sampling else samples
 
-        if train:
+        if reuse_feature_maps:
             # take mean over hessian compute for different sampled NN
-            hessian = self.laplace.average_hessian_samples(hessian, self.constant)
+            self.merge_hessian(self.laplace.average_hessian_samples(hessian, self.constant), steps)
+
+        elif compute_hessian:
+            start = time.time()
+            self.feature_maps = []
+            hessian = self.sampled_hessian(self.HessianCalculator, self.net, self.feature_maps, x_h, weights)
+            self.timings["compute_hessian"] += time.time() - start
+            self.merge_hessian(hessian, steps)
 
-            if self.update_hessian:
-                self.hessian = (
-                    self.hessian_memory_factor * self.hessian + hessian
+        elif steps > 0:
+            # the hessian of the weights of this step, after the older ones
+            start = time.time()
+            self.collect_hessians(self.hessian_staleness - 1)
+            self.timings["wait_hessian"] += time.time() - start
+
+            # detached, so the background thread holds no graph of this step
+            self.pending_hessians.append(
+                (
+                    self.hessian_executor.submit(self.background_hessian, x_h.detach(), weights.detach()),
+                    steps,
                 )
-            else:
-                self.hessian = (
-                    1 - self.hessian_memory_factor
-                ) * hessian + self.hessian_memory_factor * self.hessian
+            )
+
+        # reset the network parameters with the mean parameter (MAP estimate parameters)
+        vector_to_parameters(mu_q, self.net.parameters())
 
         loss = self.constant * mse + self.alpha * regularizer
 
@@ -154,10 +244,136 @@ class OnlineLaplace:
 
         return loss
 
-    def sample(self, n_samples = 100, last_layer=False):
-        sigma_q = self.laplace.posterior_scale(
-            self.hessian, self.hessian_scale, self.prior_prec
+    def merge_hessian(self, hessian, steps=1):
+        """merges the hessian of a step, that stands in for the steps - 1
+        skipped steps before it as well"""
+        weight = self.hessian_memory_factor**steps
+        if self.update_hessian:
+            other_weight = sum(self.hessian_memory_factor**i for i in range(steps))
+        else:
+            other_weight = 1 - weight
+
+        old_hessian = self.hessian
+        self.hessian = self.laplace.merge_hessians(self.hessian, hessian, weight, other_weight)
+        self.hessian_change = self.hessian_schedule.adapt(old_hessian, self.hessian)
+
+    def snapshot_net(self):
+        """copy of the net for the background thread, that records its own
+        feature maps, so the weights of self.net can change meanwhile"""
+        net = deepcopy(self.net)
+        feature_maps = []
+
+        def fw_hook_get_latent(module, input, output):
+            feature_maps.append(output.detach())
+
+        for k in range(len(net)):
+            net[k]._forward_hooks.clear()
+            net[k].register_forward_hook(fw_hook_get_latent)
+        return net, feature_maps
+
+    def sampled_hessian(self, calculator, net, feature_maps, x, weights):
+        """averaged hessian of the nets with the rows of weights, feature_maps
+        is the list that the hooks of net record into"""
+        hessian = []
+        # backpack backpropagates through the graph of its own forward pass
+        layerwise = isinstance(calculator, lw.HessianCalculator)
+        with torch.no_grad() if layerwise else nullcontext():
+            for net_sample in weights:
+
+                # the layerwise backend reads the weights (and e.g. the pooling
+                # indices) from the modules, so recompute the feature maps
+                # without building a graph
+                vector_to_parameters(net_sample, net.parameters())
+                if layerwise:
+                    feature_maps.clear()
+                    net(x)
+
+                h_s = calculator.__call__(net, list(feature_maps), x)
+                hessian.append(self.laplace.scale(h_s, x.shape[0], self.dataset_size))
+
+        return self.laplace.average_hessian_samples(hessian, self.constant)
+
+    def background_hessian(self, x, weights):
+        """runs in the background thread on the snapshot net, returns the
+        hessian, its compute time and the profiler records of the sweeps"""
+        profiler = getattr(self.background_calculator, "profiler", None)
+        if profiler is not None:
+            profiler.clear()
+        start = time.time()
+        hessian = self.sampled_hessian(
+            self.background_calculator, self.hessian_net, self.hessian_feature_maps, x, weights
         )
+        return hessian, time.time() - start, profiler.records if profiler is not None else []
+
+    def collect_hessians(self, max_pending=0):
+        """merges the finished background hessians in order, and waits for the
+        oldest ones until at most max_pending are left"""
+        if not self.async_hessian:
+            return
+        while self.pending_hessians and (
+            self.pending_hessians[0][0].done() or len(self.pending_hessians) > max_pending
+        ):
+            future, steps = self.pending_hessians.popleft()
+            hessian, compute_time, records = future.result()
+            self.merge_hessian(hessian, steps)
+            self.timings["compute_hessian"] += compute_time
+            if self.hessian_profiler is not None:
+                self.hessian_profiler.records.extend(records)
+
+    def sampled_forward(self, x, samples):
+        """Evaluates the network for all rows of samples ([n_samples, n_params])
+        in a single vectorized call, returns [n_samples, *output_shape]"""
+        from torch.func import functional_call, vmap
+
+        params = dict(self.net.named_parameters())
+        sizes = [p.numel() for p in params.values()]
+        sampled_params = {
+            name: sample.reshape(-1, *p.shape)
+            for (name, p), sample in zip(params.items(), samples.split(sizes, dim=1))
+        }
+
+        def forward(sampled_param):
+            return functional_call(self.net, sampled_param, (x,))
+
+        # feature maps can't escape vmap, they are recomputed when needed
+        self.record_feature_maps = False
+        try:
+            x_rec = vmap(forward)(sampled_params)
+        finally:
+            self.record_feature_maps = True
+
+        return x_rec
+
+    @property
+    def hessian_profiler(self):
+        return getattr(self.HessianCalculator, "profiler", None)
+
+    @property
+    def hessian(self):
+        return self._hessian
+
+    @hessian.setter
+    def hessian(self, hessian):
+        self._hessian = hessian
+        self.hessian_version += 1
+
+    def posterior_scale(self):
+        prior_prec = prior_precision_values(self.prior_prec)
+        if isinstance(prior_prec, dict):
+            prior_prec = tuple(prior_prec.items())
+        key = (self.hessian_version, prior_prec, float(self.hessian_scale))
+        if key != self.posterior_scale_key:
+            self.cached_posterior_scale = self.laplace.posterior_scale(
+                self.hessian,
+                self.hessian_scale,
+                prior_precision_vector(self.prior_prec, self.net),
+            )
+            self.posterior_scale_key = key
+        return self.cached_posterior_scale
+
+    def sample(self, n_samples = 100, last_layer=False):
+        self.collect_hessians()
+        sigma_q = self.posterior_scale()
         
         if last_layer:
             param_list = list(self.net.parameters())
@@ -171,12 +387,79 @@ class OnlineLaplace:
         return samples
 
     def load_hessian(self, path):
-        self.hessian = torch.load(path)
+        # older checkpoints hold only the hessian
+        checkpoint = torch.load(path)
+        if isinstance(checkpoint, dict):
+            self.prior_prec = checkpoint["prior_prec"]
+            checkpoint = checkpoint["hessian"]
+        self.hessian = checkpoint
 
     def save_hessian(self, path):
-        torch.save(self.hessian, path)
+        self.collect_hessians()
+        torch.save({"hessian": self.hessian, "prior_prec": self.prior_prec}, path)
+
+class HessianSchedule:
+    """Decides on which training steps the hessian is computed: every
+    hessian_update_every steps, on a random hessian_batch_fraction of the batch.
+    With hessian_update_tol, the interval doubles (up to
+    hessian_update_max_every) while the relative change of the running hessian
+    stays below the tolerance, and resets once it exceeds it."""
+
+    def __init__(self, config):
+        self.every = int(config["hessian_update_every"]) if "hessian_update_every" in config else 1
+        self.max_every = int(config["hessian_update_max_every"]) if "hessian_update_max_every" in config else 64
+        self.batch_fraction = float(config["hessian_batch_fraction"]) if "hessian_batch_fraction" in config else 1.0
+        self.tol = float(config["hessian_update_tol"]) if "hessian_update_tol" in config else None
+
+        self.interval = self.every
+        self.skipped = 0
+
+    def step(self):
+        """the number of steps that the hessian of this step stands for, 0 if
+        the step is skipped"""
+        self.skipped += 1
+        if self.skipped < self.interval:
+            return 0
+        steps, self.skipped = self.skipped, 0
+        return steps
+
+    def subset(self, x):
+        if self.batch_fraction >= 1:
+            return x
+        n = max(1, round(self.batch_fraction * x.shape[0]))
+        return x[torch.randperm(x.shape[0], device=x.device)[:n]]
+
+    def adapt(self, old_hessian, new_hessian):
+        """adapts the interval, returns the relative change of the hessian, or
+        None without a tolerance (the distance costs a pass over the hessian
+        and a device sync per merge)"""
+        if self.tol is None:
+            return None
+        old_norm = hessian_squared_distance(old_hessian, 0) ** 0.5
+        change = hessian_squared_distance(new_hessian, old_hessian) ** 0.5 / old_norm if old_norm > 0 else float("inf")
+        self.interval = min(2 * self.interval, self.max_every) if change < self.tol else self.every
+        return float(change)
+
+
+def hessian_squared_distance(hessian, other):
+    """squared frobenius distance of hessians of any structure (a tensor or
+    nested lists/tuples of tensors), other can be 0. Other leaves (e.g. the
+    bias flags of the kronecker factors) don't count."""
+    if torch.is_tensor(hessian):
+        return (hessian - other).pow(2).sum()
+    if not isinstance(hessian, (list, tuple)):
+        return 0
+    if isinstance(other, (int, float)):
+        return sum(hessian_squared_distance(h, other) for h in hessian)
+    return sum(hessian_squared_distance(h, o) for h, o in zip(hessian, other))
+
 
 def weight_decay(mu_q, prior_prec):
 
+    if prior_prec.dim() > 0:
+        # per parameter prior precision, equal to the scalar case if constant
+        prior_prec = prior_prec.view_as(mu_q)
+        return 0.5 * ((mu_q**2 / prior_prec).sum() + torch.log(prior_prec).mean())
+
     return 0.5 * (torch.matmul(mu_q.T, mu_q) / prior_prec + torch.log(prior_prec))
 
@@ -1,15 +1,19 @@
 from hessian import layerwise as lw
 from torch.nn.utils import parameters_to_vector
+from torch.utils.data import DataLoader, SequentialSampler, Subset
 import torch
+import os
+from copy import deepcopy
 from tqdm import tqdm
 from torch.nn import functional as F
 
-from laplace.laplace import BlockLaplace, DiagLaplace
+from laplace.laplace import BlockLaplace, DiagLaplace, KronLaplace, parametric_layers
 laplace_methods = {
     "block": BlockLaplace,
     "exact": DiagLaplace,
     "approx": DiagLaplace,
     "mix": DiagLaplace,
+    "kfac": KronLaplace,
 }
 
 
@@ -32,30 +36,180 @@ def log_marginal_likelihood(mu_q, hessian, prior_prec):
     return neg_log_marglik
 
 
-def optimize_prior_precision(mu_q, hessian, prior_prec, n_steps=100):
+def optimize_prior_precision(mu_q, eigenvalues, prior_prec=1.0, groups=None, tol=1e-6, max_iter=100):
+    """Maximizes log_marginal_likelihood over the prior precision delta, one
+    per group of parameters (groups [P] holds the group of each parameter and
+    of the eigenvalue at its position), given the eigenvalues of the hessian.
+    In t = log delta the negative log marginal likelihood is convex with
 
-    log_prior_prec = prior_prec.log()
-    log_prior_prec.requires_grad = True
-    optimizer = torch.optim.Adam([log_prior_prec], lr=1e-1)
-    for _ in range(n_steps):
-        optimizer.zero_grad()
-        prior_prec = log_prior_prec.exp()
-        neg_log_marglik = -log_marginal_likelihood(mu_q, hessian, prior_prec)
-        neg_log_marglik.backward()
-        optimizer.step()
+        g'(t)  = delta |mu|^2 - sum lambda / (lambda + delta)
+        g''(t) = delta |mu|^2 + sum lambda delta / (lambda + delta)^2
 
-    prior_prec = log_prior_prec.detach().exp()
+    so Newton's method in t, safeguarded by bisection, converges in a few
+    vectorized passes over the eigenvalues."""
+    if groups is None:
+        groups = torch.zeros(len(mu_q), dtype=torch.long, device=mu_q.device)
+    n_groups = int(groups.max()) + 1
+
+    def group_sum(x):
+        return torch.zeros(n_groups, dtype=x.dtype, device=x.device).index_add_(0, groups, x)
+
+    eigenvalues = eigenvalues.detach().double()
+    mu_sq = group_sum(mu_q.detach().double() ** 2).clamp(min=1e-30)
+
+    # the root is below delta = P / |mu|^2, where the first term dominates
+    hi = (group_sum(torch.ones_like(eigenvalues)) / mu_sq).log()
+    lo = hi - 60
+    t = torch.full((n_groups,), float(prior_prec), dtype=torch.double, device=mu_q.device).log()
+    t = t.clamp(lo, hi)
+
+    for _ in range(max_iter):
+        delta = t.exp()
+        ratio = eigenvalues / (eigenvalues + delta[groups])
+        grad = delta * mu_sq - group_sum(ratio)
+        hess = delta * mu_sq + group_sum(ratio * (1 - ratio))
+
+        # the derivative increases in t, so its sign brackets the root
+        lo = torch.where(grad < 0, t, lo)
+        hi = torch.where(grad > 0, t, hi)
+
+        t_new = t - grad / hess
+        outside = (t_new <= lo) | (t_new >= hi)
+        t_new = torch.where(outside, (lo + hi) / 2, t_new)
+
+        converged = (t_new - t).abs().max() < tol
+        t = t_new
+        if converged:
+            break
+
+    prior_prec = t.exp().to(mu_q.dtype)
+    return prior_prec[0] if n_groups == 1 else prior_prec
+
+
+def layer_groups(net):
+    """the index of the (parametric) layer of every parameter of the net"""
+    sizes = [sum(p.numel() for p in layer.parameters()) for layer in net]
+    sizes = torch.tensor([n for n in sizes if n > 0])
+    return torch.repeat_interleave(torch.arange(len(sizes)), sizes)
+
+
+def save_checkpoint(path, hessian, n_batches, order):
+    # write to a temporary file first, so a crash never leaves a broken checkpoint
+    torch.save({"hessian": hessian, "n_batches": n_batches, "order": order}, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+
+def ordered_loader(loader, order):
+    """loader over the data of loader in the fixed order of the sample
+    indices, e.g. the order that a shuffling sampler drew for the checkpoint"""
+    if loader.batch_size is None:
+        raise ValueError("a checkpointed fit needs a loader with a batch_size, not a batch_sampler")
+
+    return DataLoader(
+        Subset(loader.dataset, order.tolist()),
+        batch_size=loader.batch_size,
+        drop_last=loader.drop_last,
+        num_workers=loader.num_workers,
+        pin_memory=loader.pin_memory,
+        collate_fn=loader.collate_fn,
+    )
+
+
+def skip_batches(loader, n_batches):
+    """loader over the same (sequential) data without the first n_batches"""
+    if n_batches == 0:
+        return loader
+
+    if not isinstance(loader.sampler, SequentialSampler):
+        raise ValueError(
+            "only a sequential loader can skip batches, fix the order with ordered_loader first"
+        )
+    start = min(n_batches * loader.batch_size, len(loader.dataset))
+    return DataLoader(
+        Subset(loader.dataset, range(start, len(loader.dataset))),
+        batch_size=loader.batch_size,
+        drop_last=loader.drop_last,
+        num_workers=loader.num_workers,
+        pin_memory=loader.pin_memory,
+        collate_fn=loader.collate_fn,
+    )
+
+
+def flatten_hessian(hessian):
+    """tensor, list of tensors or list of tuples of tensors -> list of tensors,
+    other leaves (e.g. the bias flags of the kronecker factors) are skipped"""
+    if torch.is_tensor(hessian):
+        return [hessian]
+    if not isinstance(hessian, (list, tuple)):
+        return []
+    return [h_i for h in hessian for h_i in flatten_hessian(h)]
+
+
+def unflatten_hessian(like, tensors):
+    """inverse of flatten_hessian, with the structure of like"""
+    tensors = iter(tensors)
+
+    def unflatten(h):
+        if torch.is_tensor(h):
+            return next(tensors)
+        if not isinstance(h, (list, tuple)):
+            return h
+        return type(h)(unflatten(h_i) for h_i in h)
+
+    return unflatten(like)
+
+
+def shard_loader(loader, shard, n_shards):
+    """loader over the shard-th of n_shards disjoint contiguous parts of the data"""
+    n_data = len(loader.dataset)
+    start, end = shard * n_data // n_shards, (shard + 1) * n_data // n_shards
+    return DataLoader(
+        Subset(loader.dataset, range(start, end)),
+        batch_size=loader.batch_size,
+        num_workers=loader.num_workers,
+        pin_memory=loader.pin_memory,
+        collate_fn=loader.collate_fn,
+    )
+
+
+def fit_worker(rank, n_workers, laplace_args, loader, n_batches, like, buffers, lock, n_fitted, n_threads, seed):
+    """fits the rank-th contiguous slice of the n_batches batches of the loader
+    (dataset, batch_size, collate_fn) and sums each batch hessian into the
+    shared buffers (flattened like the hessian like)"""
+    torch.set_num_threads(n_threads)
+    # the monte carlo samples (e.g. of kfac) differ between the workers
+    torch.manual_seed(seed + rank)
+    la = PosthocLaplace(*laplace_args)
+
+    dataset, batch_size, collate_fn = loader
+    start, end = rank * n_batches // n_workers, (rank + 1) * n_batches // n_workers
+    loader = DataLoader(
+        Subset(dataset, range(start * batch_size, min(end * batch_size, len(dataset)))),
+        batch_size=batch_size,
+        collate_fn=collate_fn,
+    )
+
+    for X, _ in loader:
+        h_s = la.hessian_batch(X)
+        with lock:
+            hessian = la.laplace.merge_hessians(unflatten_hessian(like, buffers), h_s)
+            for buffer, h in zip(buffers, flatten_hessian(hessian)):
+                buffer.copy_(h)
+            n_fitted += 1
 
-    return prior_prec
-    
 
 class PosthocLaplace:
-    def __init__(self, net, approx, classification):
+    def __init__(self, net, approx, classification, memory_budget=None, mc_samples=1):
         super(PosthocLaplace, self).__init__()
 
         self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
         self.feature_maps = []
         self.net = net
+        # the workers of the parallel fit are built from the same arguments
+        self.approx = approx
+        self.classification = classification
+        self.memory_budget = memory_budget
+        self.mc_samples = mc_samples
 
         def fw_hook_get_latent(module, input, output):
             self.feature_maps.append(output.detach())
@@ -64,28 +218,146 @@ class PosthocLaplace:
             self.net[k].register_forward_hook(fw_hook_get_latent)
 
         if classification:
-            self.HessianCalculator = lw.CrossEntropyHessianCalculator(approx)
+            self.HessianCalculator = lw.CrossEntropyHessianCalculator(approx, mc_samples=mc_samples)
         else:
-            self.HessianCalculator = lw.MseHessianCalculator(approx)
+            self.HessianCalculator = lw.MseHessianCalculator(approx, memory_budget, mc_samples=mc_samples)
+        self.laplace = laplace_methods[approx]()
+        if approx == "kfac":
+            lw.check_kfac_layers(net)
 
-    def fit(self, train_loader):
+    def fit(self, train_loader, checkpoint_path=None, checkpoint_every=100, n_workers=1):
 
-        hessian = None
-        for X, y in tqdm(train_loader):
-            X = X.to(self.device)
-            with torch.inference_mode():
-                self.feature_maps = []
-                x_rec = self.net(X)
-            h_s = self.HessianCalculator.__call__(self.net, self.feature_maps, x_rec)
+        # resume from the partial sum of a previous (crashed) fit
+        hessian, n_batches, order = None, 0, None
+        if checkpoint_path is not None and os.path.isfile(checkpoint_path):
+            checkpoint = torch.load(checkpoint_path, map_location=self.device)
+            hessian, n_batches = checkpoint["hessian"], checkpoint["n_batches"]
+            # older checkpoints were only written for sequential loaders
+            order = checkpoint.get("order", torch.arange(len(train_loader.dataset)))
+            print(f"==> resume hessian from {checkpoint_path} at batch {n_batches}")
 
+        # the order of the samples is drawn once and stored with the
+        # checkpoints, so resuming skips the right batches for any sampler
+        if checkpoint_path is not None:
+            if order is None:
+                order = torch.tensor(list(train_loader.sampler), dtype=torch.long)
+            train_loader = ordered_loader(train_loader, order)
+
+        # the parallel fit only checkpoints at the end
+        if n_workers > 1:
+            h_s = self.fit_parallel(skip_batches(train_loader, n_batches), n_workers)
+            if hessian is None:
+                hessian = h_s
+            elif h_s is not None:
+                hessian = self.laplace.merge_hessians(hessian, h_s)
+
+        else:
+            for i, (X, y) in enumerate(
+                tqdm(skip_batches(train_loader, n_batches)), start=n_batches
+            ):
+                h_s = self.hessian_batch(X)
+
+                if hessian is None:
+                    hessian = h_s
+                else:
+                    hessian = self.laplace.merge_hessians(hessian, h_s)
+
+                if checkpoint_path is not None and (i + 1) % checkpoint_every == 0:
+                    save_checkpoint(checkpoint_path, hessian, i + 1, order)
+
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, hessian, len(train_loader), order)
+
+        self.hessian = hessian
+
+    def hessian_batch(self, X):
+        X = X.to(self.device)
+        with torch.inference_mode():
+            self.feature_maps = []
+            x_rec = self.net(X)
+        return self.HessianCalculator.__call__(self.net, self.feature_maps, x_rec)
+
+    def fit_parallel(self, train_loader, n_workers):
+        """Data parallel fit in n_workers spawned cpu processes, each with its own
+        replica of the net and a contiguous slice of the batches. The hessian
+        of every batch is summed into one shared memory accumulator under a
+        lock, so the reduction holds a single hessian whatever n_workers."""
+        if self.device != "cpu":
+            raise ValueError("the parallel fit runs on cpu")
+
+        n_batches = len(train_loader)
+        if n_batches == 0:
+            return None
+
+        # the zero hessian gives the structure of the accumulator
+        like = self.laplace.init_hessian(0, self.net, self.device)
+        buffers = [torch.zeros_like(h).share_memory_() for h in flatten_hessian(like)]
+        n_fitted = torch.zeros(1, dtype=torch.long).share_memory_()
+        n_threads = max(1, torch.get_num_threads() // n_workers)
+        seed = int(torch.randint(2**62, ()))
+
+        # spawn, as forking after torch ran in this process can deadlock the
+        # intra-op thread pool of the children; the replica is pickled
+        # without the hooks, the workers register their own
+        net = deepcopy(self.net)
+        for layer in net:
+            layer._forward_hooks.clear()
+
+        context = torch.multiprocessing.get_context("spawn")
+        lock = context.Lock()
+        loader = (train_loader.dataset, train_loader.batch_size, train_loader.collate_fn)
+        processes = [
+            context.Process(
+                target=fit_worker,
+                args=(
+                    rank,
+                    n_workers,
+                    (net, self.approx, self.classification, self.memory_budget, self.mc_samples),
+                    loader,
+                    n_batches,
+                    like,
+                    buffers,
+                    lock,
+                    n_fitted,
+                    n_threads,
+                    seed,
+                ),
+            )
+            for rank in range(n_workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        if any(process.exitcode != 0 for process in processes):
+            raise RuntimeError("a worker of the parallel hessian fit failed")
+
+        if n_fitted[0] == 0:
+            return None
+        return unflatten_hessian(like, [buffer.clone() for buffer in buffers])
+
+    def reduce(self, checkpoint_paths):
+        """sum the hessians of the shards fitted to the given checkpoints"""
+        hessian = None
+        for path in checkpoint_paths:
+            h_s = torch.load(path, map_location=self.device)["hessian"]
             if hessian is None:
                 hessian = h_s
             else:
-                hessian += h_s
+                hessian = self.laplace.merge_hessians(hessian, h_s)
 
         self.hessian = hessian
 
-    def optimize_precision(self):
+    def optimize_precision(self, per_layer=False):
+        """one prior precision for all parameters, or with per_layer one for
+        each parametric layer {layer index: precision}, solved jointly"""
         mu_q = parameters_to_vector(self.net.parameters())
-        self.prior_prec = optimize_prior_precision(mu_q, self.hessian, torch.tensor(1))
-        
+        eigenvalues = self.laplace.eigenvalues(self.hessian)
+        if not per_layer:
+            self.prior_prec = optimize_prior_precision(mu_q, eigenvalues)
+            return
+
+        prior_prec = optimize_prior_precision(
+            mu_q, eigenvalues, groups=layer_groups(self.net).to(mu_q.device)
+        )
+        self.prior_prec = dict(zip(parametric_layers(self.net), prior_prec.view(-1)))
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from torch.nn.utils import parameters_to_vector
+
+# file layout: 8 byte little endian header length, json header padded to
+# ALIGNMENT bytes, then the raw [n_samples, n_params] float32 samples
+ALIGNMENT = 64
+VERSION = 1
+
+
+def tensor_hash(tensors):
+    """sha256 of a (nested list/tuple of) tensor(s) and scalars"""
+    sha = hashlib.sha256()
+
+    def update(t):
+        if torch.is_tensor(t):
+            sha.update(t.detach().cpu().contiguous().numpy().tobytes())
+        elif isinstance(t, (list, tuple)):
+            for t_i in t:
+                update(t_i)
+        else:
+            sha.update(repr(t).encode())
+
+    update(tensors)
+    return sha.hexdigest()
+
+
+def prior_precision_header(prior_prec):
+    # json keys are strings, so per layer prior precisions are keyed by str(index)
+    if isinstance(prior_prec, dict):
+        return {str(i): float(p) for i, p in prior_prec.items()}
+    return float(prior_prec)
+
+
+def sample_bank_header(net, hessian, prior_prec, hessian_scale, seed, n_samples):
+    """the header identifies the posterior that the samples are drawn from"""
+    return {
+        "version": VERSION,
+        "n_samples": n_samples,
+        "n_params": sum(p.numel() for p in net.parameters()),
+        "dtype": "float32",
+        "net_hash": tensor_hash(parameters_to_vector(net.parameters())),
+        "hessian_hash": tensor_hash(hessian),
+        "prior_precision": prior_precision_header(prior_prec),
+        "hessian_scale": float(hessian_scale),
+        "seed": seed,
+    }
+
+
+def save_sample_bank(path, samples, header):
+    header = json.dumps(header).encode()
+    pad = -(8 + len(header)) % ALIGNMENT
+    header += b" " * pad
+
+    # write to a temporary file first, so a crash never leaves a partial bank
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        f.write(samples.detach().cpu().float().contiguous().numpy().tobytes())
+    os.replace(f"{path}.tmp", path)
+
+
+def load_sample_bank(path):
+    """memory maps the samples of the bank (zero-copy, copy on write),
+    returns the samples [n_samples, n_params] and the header"""
+    with open(path, "rb") as f:
+        header_length = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_length))
+
+    samples = np.memmap(
+        path,
+        dtype=np.float32,
+        mode="c",
+        offset=8 + header_length,
+        shape=(header["n_samples"], header["n_params"]),
+    )
+    return torch.from_numpy(samples), header
+
+
+def sample_from_bank(path, header, sample_fn):
+    """samples of the bank at path if it was drawn from the posterior of
+    header, otherwise draws them with sample_fn under the seed of the header
+    (without reseeding the global rng) and stores them in the bank"""
+    if os.path.isfile(path):
+        samples, bank_header = load_sample_bank(path)
+        if bank_header == header:
+            print(f"==> load samples from {path}")
+            return samples
+
+    # seeded on a fork of the rng, so the caller's random stream is untouched
+    with torch.random.fork_rng():
+        torch.manual_seed(header["seed"])
+        samples = sample_fn()
+    save_sample_bank(path, samples, header)
+    print(f"==> save samples to {path}")
+    return samples
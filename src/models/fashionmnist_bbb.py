@@ -2,6 +2,7 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from utils import RunningMoments
 
 # implementation inspired from
 # https://github.com/nitarshan/bayes-by-backprop/blob/master/Weight%20Uncertainty%20in%20Neural%20Networks.ipynb
@@ -155,24 +156,17 @@ class BayesianAE(nn.Module):
 
     def sample_decoder(self, z, samples=1):
 
-        x_rec = None
-        x_rec2 = None
+        moments = RunningMoments()
         for i in range(samples):
             x = torch.tanh(z)
             x = torch.tanh(self.d1(x, True))
             x = torch.tanh(self.d2(x, True))
             x = torch.tanh(self.d3(x, True))
             x = torch.tanh(self.d4(x, True))
+            moments.update(x)
 
-            if x_rec is None:
-                x_rec = x
-                x_rec2 = x**2
-            else:
-                x_rec += x
-                x_rec2 += x**2
-
-        x_rec_mu = x_rec / samples
-        x_rec_var = x_rec2 / samples - x_rec_mu**2
+        x_rec_mu = moments.mean
+        x_rec_var = moments.var()
 
         return x_rec_mu, x_rec_var
 
@@ -180,10 +174,8 @@ class BayesianAE(nn.Module):
         bs, outsize = input.shape
 
         # allocate memory
-        x_rec = None
-        x_rec2 = None
-        z = None
-        z2 = None
+        x_rec = RunningMoments()
+        z = RunningMoments()
         log_priors = None
         log_variational_posteriors = None
 
@@ -193,28 +185,22 @@ class BayesianAE(nn.Module):
             log_priors_i = self.log_prior()
             log_variational_posteriors_i = self.log_variational_posterior()
 
-            if z is None:
-                z = z_i
-                z2 = z_i**2
-                x_rec = outputs_i
-                x_rec2 = outputs_i**2
+            z.update(z_i)
+            x_rec.update(outputs_i)
+            if log_priors is None:
                 log_priors = log_priors_i
                 log_variational_posteriors = log_variational_posteriors_i
             else:
-                z += z_i
-                z2 += z_i**2
-                x_rec += outputs_i
-                x_rec2 += outputs_i**2
                 log_priors += log_priors_i
                 log_variational_posteriors += log_variational_posteriors_i
 
         log_prior = log_priors / samples
         log_variational_posterior = log_variational_posteriors / samples
 
-        mu_x_hat = x_rec / samples
-        sigma_x_hat = (x_rec2 / samples - mu_x_hat**2) ** 0.5
-        mu_z_hat = z / samples
-        sigma_z_hat = (z2 / samples - mu_z_hat**2) ** 0.5
+        mu_x_hat = x_rec.mean
+        sigma_x_hat = x_rec.var() ** 0.5
+        mu_z_hat = z.mean
+        sigma_z_hat = z.var() ** 0.5
         negative_log_likelihood = F.mse_loss(mu_x_hat, target, reduction="mean")
 
         loss = (
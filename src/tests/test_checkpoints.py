@@ -0,0 +1,53 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import json
+
+import numpy as np
+import pytest
+import torch
+from laplace.laplace import LowRankLaplace
+from utils import load_laplace, load_tensors, save_laplace, save_tensors
+
+
+class FittedLaplace:
+    def __init__(self):
+        self.model = torch.nn.Linear(2, 2)
+        self.loss_fn = torch.nn.functional.mse_loss
+        self.H = torch.ones(6)
+        self.structure = LowRankLaplace(rank=3)
+
+
+def test_tensor_checkpoints_round_trip(tmp_path):
+    path = str(tmp_path / "ckpt")
+    save_tensors(path, {"h": [(torch.arange(3.0), 2)], "la": LowRankLaplace(rank=3)})
+    tree = load_tensors(path)
+    assert torch.equal(tree["h"][0][0], torch.arange(3.0)) and tree["h"][0][1] == 2
+    assert isinstance(tree["la"], LowRankLaplace) and tree["la"].rank == 3
+
+
+def test_checkpoints_only_instantiate_allowed_classes(tmp_path):
+    path = str(tmp_path / "ckpt")
+    with pytest.raises(ValueError):
+        save_tensors(path, {"rng": np.random.default_rng()})
+
+    # a forged header that names any other class
+    header = json.dumps({"tree": {"__object__": "subprocess.Popen", "state": None}, "tensors": []}).encode()
+    with open(path, "wb") as f:
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+    with pytest.raises(ValueError):
+        load_tensors(path)
+
+
+def test_save_laplace_reports_the_attributes_it_drops(tmp_path):
+    path = str(tmp_path / "ckpt")
+    la = FittedLaplace()
+    la.counts = np.zeros(3)
+    with pytest.warns(UserWarning, match="counts"):
+        save_laplace(la, path)
+
+    loaded = load_laplace(path, FittedLaplace())
+    assert torch.equal(loaded.H, la.H) and loaded.structure.rank == 3
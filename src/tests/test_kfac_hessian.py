@@ -0,0 +1,56 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import pytest
+import torch
+from torch.nn.utils import parameters_to_vector
+from stochman import nnj
+from hessian import layerwise as lw
+from laplace.laplace import KronLaplace
+
+
+def feature_maps(net, x):
+    maps = []
+    with torch.no_grad():
+        for layer in net:
+            x = layer(x)
+            maps.append(x)
+    return maps
+
+
+def test_kfac_output_factor_matches_the_averaged_output_hessian():
+    torch.manual_seed(0)
+    net = nnj.Sequential(nnj.Linear(3, 4), nnj.Tanh(), nnj.Linear(4, 3))
+    x = torch.randn(2, 3)
+
+    A, G, bias = lw.MseHessianCalculator("kfac", mc_samples=20000)(net, feature_maps(net, x), x)[0]
+
+    # the mse output hessian backpropagated to the output of the first layer
+    J = torch.stack([torch.autograd.functional.jacobian(net[1:], f) for f in feature_maps(net, x)[0]])
+    G_ref = torch.einsum("bdi,bdj->ij", J, J) / 2
+    a = torch.cat([x, torch.ones(2, 1)], dim=1)
+
+    assert bias
+    assert torch.allclose(A, a.T @ a)
+    assert torch.allclose(G, G_ref, atol=0.05 * G_ref.abs().max())
+
+
+def test_kron_samples_without_init_hessian():
+    net = nnj.Sequential(nnj.Conv2d(1, 2, 3, bias=False), nnj.Flatten(), nnj.Linear(8, 3))
+    hessian = KronLaplace().init_hessian(10, net, "cpu")
+
+    # e.g. a loaded or reduced hessian, sampled by a fresh instance
+    la = KronLaplace()
+    mu = parameters_to_vector(net.parameters())
+    samples = la.sample(mu, la.posterior_scale(hessian, 1, 1), n_samples=4)
+    assert samples.shape == (4, len(mu))
+
+
+def test_kfac_rejects_unsupported_layers():
+    net = nnj.Sequential(nnj.Linear(3, 4), nnj.ConvTranspose2d(4, 4, 1))
+    with pytest.raises(ValueError):
+        KronLaplace().init_hessian(10, net, "cpu")
+    with pytest.raises(ValueError):
+        lw.check_kfac_layers(net)
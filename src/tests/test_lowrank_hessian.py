@@ -0,0 +1,101 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import torch
+from torch.nn.utils import parameters_to_vector
+from torch.func import functional_call, jacrev
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+from stochman import nnj
+from hessian import layerwise as lw
+from laplace.laplace import LowRankLaplace
+from laplace.posthoclaplace import layer_groups, optimize_prior_precision
+
+
+class LargestTensor(TorchDispatchMode):
+    """records the number of elements of the largest tensor that any op returns"""
+
+    def __init__(self):
+        super(LargestTensor, self).__init__()
+        self.numel = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        for t in tree_flatten(out)[0]:
+            if isinstance(t, torch.Tensor):
+                self.numel = max(self.numel, t.numel())
+        return out
+
+
+def feature_maps(net, x):
+    maps = []
+    with torch.no_grad():
+        for layer in net:
+            x = layer(x)
+            maps.append(x)
+    return maps
+
+
+def test_lowrank_matches_dense_ggn_at_full_rank():
+    torch.manual_seed(0)
+    net = nnj.Sequential(nnj.Linear(5, 4), nnj.Tanh(), nnj.Linear(4, 5))
+    x = torch.randn(3, 5)
+
+    H = lw.MseHessianCalculator("lowrank", rank=30)(net, feature_maps(net, x), x)
+
+    params = {n: p.detach() for n, p in net.named_parameters()}
+    J = jacrev(lambda p: functional_call(net, p, (x,)))(params)
+    J = torch.cat([J[n].reshape(x.numel(), -1) for n in params], dim=1)
+    G = J.T @ J
+
+    start = 0
+    for d, U in H:
+        end = start + len(d)
+        assert torch.allclose(torch.diag(d) + U @ U.T, G[start:end, start:end], atol=1e-4)
+        start = end
+
+
+def test_lowrank_never_allocates_the_dense_block():
+    torch.manual_seed(0)
+    net = nnj.Sequential(
+        nnj.Linear(10, 1000), nnj.Tanh(), nnj.Linear(1000, 1000), nnj.Tanh(), nnj.Linear(1000, 10)
+    )
+    x = torch.randn(2, 10)
+    n_params = sum(p.numel() for p in net[2].parameters())
+
+    with LargestTensor() as largest:
+        H = lw.MseHessianCalculator("lowrank", rank=5)(net, feature_maps(net, x), x)
+
+    # the dense [P, P] block of the middle layer would be 10^12 elements
+    assert largest.numel < 100 * n_params
+    assert H[1][0].shape == (n_params,) and H[1][1].shape == (n_params, 5)
+
+
+def test_lowrank_eigenvalues_match_the_dense_spectrum():
+    torch.manual_seed(0)
+    net = nnj.Sequential(nnj.Linear(5, 8), nnj.Tanh(), nnj.Linear(8, 5))
+    x = torch.randn(3, 5)
+    H = lw.MseHessianCalculator("lowrank", rank=3)(net, feature_maps(net, x), x)
+    la = LowRankLaplace(rank=3)
+
+    eigenvalues = la.eigenvalues(H)
+    mu_q = parameters_to_vector(net.parameters())
+    assert eigenvalues.shape == mu_q.shape
+
+    for (d, U), e in zip(H, eigenvalues.split([len(d) for d, _ in H])):
+        dense = torch.linalg.eigvalsh(torch.diag(d) + U @ U.T)
+        assert torch.allclose(e.sum(), dense.sum(), rtol=1e-4)
+        # the curvature term of the marginal likelihood
+        for delta in [0.1, 1.0]:
+            ratio, ratio_dense = (e / (e + delta)).sum(), (dense / (dense + delta)).sum()
+            assert torch.allclose(ratio, ratio_dense, rtol=0.05)
+
+    # exact for a constant diagonal
+    d, U = torch.full((6,), 0.5), torch.randn(6, 3)
+    dense = torch.linalg.eigvalsh(torch.diag(d) + U @ U.T)
+    assert torch.allclose(la.eigenvalues([(d, U)]).sort().values, dense, atol=1e-5)
+
+    prior_prec = optimize_prior_precision(mu_q.detach(), eigenvalues, groups=layer_groups(net))
+    assert torch.isfinite(prior_prec).all() and (prior_prec > 0).all()
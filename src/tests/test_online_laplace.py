@@ -0,0 +1,63 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import torch
+from stochman import nnj
+from laplace.onlinelaplace import OnlineLaplace
+
+
+def online_laplace(**config):
+    torch.manual_seed(0)
+    net = nnj.Sequential(nnj.Linear(5, 4), nnj.Tanh(), nnj.Linear(4, 5))
+    if config.get("backend") == "backpack":
+        # backpack only extends the torch modules, the weights are the same
+        torch_net = torch.nn.Sequential(torch.nn.Linear(5, 4), torch.nn.Tanh(), torch.nn.Linear(4, 5))
+        torch_net.load_state_dict(net.state_dict())
+        net = torch_net
+    config = {
+        "backend": "layer",
+        "approximation": "exact",
+        "prior_precision": 1.0,
+        "hessian_scale": 1.0,
+        "train_samples": 2,
+        **config,
+    }
+    return OnlineLaplace(net, 100, config)
+
+
+def test_background_hessians_are_profiled_on_their_own_profiler():
+    la = online_laplace(async_hessian=True, profile_hessian=True)
+    assert la.background_calculator.profiler is not la.hessian_profiler
+
+    for _ in range(3):
+        x = torch.randn(8, 5)
+        la.elbo(x).backward()
+        la.net.zero_grad()
+    la.collect_hessians()
+
+    # the records of the background sweeps end up on the main profiler
+    assert len(la.hessian_profiler.records) > 0
+    assert len(la.pending_hessians) == 0
+
+
+def test_hessian_change_is_only_computed_with_a_tolerance():
+    la = online_laplace()
+    la.elbo(torch.randn(8, 5))
+    assert la.hessian_change is None
+
+    la = online_laplace(hessian_update_tol=1e-3)
+    la.elbo(torch.randn(8, 5))
+    assert la.hessian_change > 0
+
+
+def test_backpack_hessian_of_the_mean_weights():
+    # one_hessian_per_sampling recomputes the hessian after the sampled passes
+    x = torch.randn(8, 5)
+    hessians = []
+    for backend in ["backpack", "layer"]:
+        la = online_laplace(backend=backend, one_hessian_per_sampling=True)
+        la.elbo(x)
+        hessians.append(la.hessian)
+    assert torch.allclose(*hessians, atol=1e-5)
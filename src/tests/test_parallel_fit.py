@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import pytest
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+from stochman import nnj
+from laplace.posthoclaplace import PosthocLaplace
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+@pytest.mark.parametrize("approx", ["exact", "kfac"])
+def test_parallel_fit_matches_sequential_fit(approx, shuffle):
+    torch.manual_seed(0)
+    net = nnj.Sequential(nnj.Linear(5, 4), nnj.Tanh(), nnj.Linear(4, 5))
+    x = torch.randn(10, 5)
+    loader = DataLoader(TensorDataset(x, x), batch_size=3, shuffle=shuffle)
+
+    # enough monte carlo samples that the kfac output factors agree
+    sequential = PosthocLaplace(net, approx, classification=False, mc_samples=5000)
+    sequential.fit(loader)
+    parallel = PosthocLaplace(net, approx, classification=False, mc_samples=5000)
+    parallel.fit(loader, n_workers=2)
+
+    if approx == "kfac":
+        for (A, G, bias), (A_p, G_p, bias_p) in zip(sequential.hessian, parallel.hessian):
+            assert torch.allclose(A, A_p, atol=1e-5) and bias == bias_p
+            assert torch.allclose(G, G_p, atol=0.05 * G.abs().max())
+    else:
+        assert torch.allclose(sequential.hessian, parallel.hessian, atol=1e-5)
+
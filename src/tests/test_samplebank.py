@@ -0,0 +1,21 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import torch
+from laplace.samplebank import sample_from_bank
+
+
+def test_sample_from_bank_leaves_the_global_rng_alone(tmp_path):
+    header = {"seed": 0, "n_samples": 3, "n_params": 4}
+
+    torch.manual_seed(1)
+    expected = torch.rand(2)
+    torch.manual_seed(1)
+    samples = sample_from_bank(str(tmp_path / "bank"), header, lambda: torch.randn(3, 4))
+    assert torch.equal(torch.rand(2), expected)
+
+    # drawn under the seed of the header
+    torch.manual_seed(0)
+    assert torch.equal(samples, torch.randn(3, 4))
@@ -0,0 +1,32 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import pytest
+import torch
+from stochman import nnj
+from hessian import layerwise as lw
+
+
+@pytest.mark.skipif(lw.reset_peak_rss() is None, reason="the peak rss is read from /proc")
+def test_cpu_sweeps_record_the_peak_memory():
+    profiler = lw.SweepProfiler()
+    with profiler(0, nnj.Linear(2, 2), "exact", "weight", torch.zeros(1)):
+        # 256 MB, freed before the sandwich ends
+        x = torch.ones(64 * 2**20)
+        x += 1
+        del x
+    assert profiler.records[0]["peak_memory_mb"] > 200
+
+    torch.manual_seed(0)
+    net = nnj.Sequential(nnj.Linear(5, 4), nnj.Tanh(), nnj.Linear(4, 5))
+    x = torch.randn(3, 5)
+    feature_maps = []
+    with torch.no_grad():
+        for layer in net:
+            feature_maps.append(layer(feature_maps[-1] if feature_maps else x))
+    calculator = lw.MseHessianCalculator("exact", profile=True)
+    calculator(net, feature_maps, x)
+    assert all(r["peak_memory_mb"] is not None for r in calculator.profiler.records)
+    assert "hessian/0_Linear/weight_peak_mb" in calculator.profiler.summary()
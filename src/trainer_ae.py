@@ -227,7 +227,9 @@ def test_ae(config):
     else:
         var_decoder = None
 
-    train_loader, val_loader = get_data(config["dataset"], config["batch_size"])
+    train_loader, val_loader = get_data(
+        config["dataset"], config["batch_size"], cached=config.get("cached_data", False)
+    )
 
     # forward eval
     x, z, x_rec_mu, x_rec_log_sigma, labels = inference_on_dataset(
@@ -253,7 +255,11 @@ def test_ae(config):
 
     plot_reconstructions(path, x, x_rec_mu, x_rec_log_sigma)
     if config["ood"]:
-        _, ood_val_loader = get_data(config["ood_dataset"], config["batch_size"])
+        _, ood_val_loader = get_data(
+            config["ood_dataset"],
+            config["batch_size"],
+            cached=config.get("cached_data", False),
+        )
 
         (
             ood_x,
@@ -311,7 +317,9 @@ def test_ae(config):
 def train_ae(config):
 
     # data
-    train_loader, val_loader = get_data(config["dataset"])
+    train_loader, val_loader = get_data(
+        config["dataset"], cached=config.get("cached_data", False)
+    )
 
     # model
     model = LitAutoEncoder(config)
@@ -196,7 +196,9 @@ def test_ae(config):
     net = BayesianAE(latent_size).eval().to(device)
     net.load_state_dict(torch.load(f"../weights/{path}/net.pth"))
 
-    train_loader, val_loader = get_data(config["dataset"], config["batch_size"])
+    train_loader, val_loader = get_data(
+        config["dataset"], config["batch_size"], cached=config.get("cached_data", False)
+    )
 
     # forward eval
     (
@@ -223,7 +225,11 @@ def test_ae(config):
 
     plot_reconstructions(path, x, x_rec_mu, x_rec_sigma)
     if config["ood"]:
-        _, ood_val_loader = get_data(config["ood_dataset"], config["batch_size"])
+        _, ood_val_loader = get_data(
+            config["ood_dataset"],
+            config["batch_size"],
+            cached=config.get("cached_data", False),
+        )
 
         (
             ood_x,
@@ -271,7 +277,9 @@ def test_ae(config):
 def train_ae(config):
 
     # data
-    train_loader, val_loader = get_data(config["dataset"])
+    train_loader, val_loader = get_data(
+        config["dataset"], cached=config.get("cached_data", False)
+    )
 
     # model
     model = LitAutoEncoder(config, len(train_loader))
@@ -1,10 +1,13 @@
 import os
 import torch
-import tqdm
+from tqdm import tqdm
 import numpy as np
 import yaml
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
+from multiprocessing import get_context
+from torch.func import functional_call, stack_module_state, vmap
 from data import get_data, generate_latent_grid
 from models import get_encoder, get_decoder
 from visualizer import (
@@ -15,42 +18,59 @@ from visualizer import (
     save_metric,
 )
 import json
-from utils import create_exp_name, compute_typicality_score
+from utils import create_exp_name, compute_typicality_score, RunningMoments
+
+
+class StackedEnsemble:
+    """The weights of the ensemble members stacked along a leading dimension,
+    so that all members are evaluated as one batched model"""
+
+    def __init__(self, members):
+        self.params, self.buffers = stack_module_state(members)
+        # the weights of the base are never used, only its forward
+        self.base = deepcopy(members[0]).to("meta")
+
+    def __len__(self):
+        return len(next(iter(self.params.values())))
+
+    def __call__(self, x):
+        """x is shared by all members, returns [num_models, *output_shape]"""
+
+        def forward(params, buffers):
+            return functional_call(self.base, (params, buffers), (x,))
+
+        return vmap(forward)(self.params, self.buffers)
+
+    def stacked(self, xs):
+        """xs holds an input per member [num_models, *input_shape]"""
+
+        def forward(params, buffers, x):
+            return functional_call(self.base, (params, buffers), (x,))
+
+        return vmap(forward)(self.params, self.buffers, xs)
 
 
 def inference_on_dataset(encoders, mu_decoders, val_loader, device):
-    num_models = len(encoders)
-    x, z, x_rec_mu, x_rec_log_sigma, labels = [], [], [], [], []
+    x, z, x_rec_mu, x_rec_sigma, labels = [], [], [], [], []
     for i, (xi, yi) in tqdm(enumerate(val_loader)):
         b, c, h, w = xi.shape
 
         xi = xi.to(device)
 
-        zi_sum, x_reci_sum, x_reci_sum2 = None, None, None
+        zi_moments, x_reci_moments = RunningMoments(), RunningMoments()
 
-        for m_idx in range(num_models):
-            with torch.inference_mode():
-                zi = encoders[m_idx](xi)
-                x_reci = mu_decoders[m_idx](zi)
+        # every member decodes its own latent
+        with torch.inference_mode():
+            zi = encoders(xi)
+            x_reci = mu_decoders.stacked(zi)
 
-            if zi_sum is None:
-                zi_sum = zi
-                x_reci_sum = x_reci
-                x_reci_sum2 = x_reci**2
-            else:
-                zi_sum += zi
-                x_reci_sum += x_reci
-                x_reci_sum2 += x_reci**2
+        zi_moments.update_batch(zi)
+        x_reci_moments.update_batch(x_reci)
 
         x += [xi.view(b, c, h, w).cpu()]
-        x_reci_avg = x_reci.view(b, c, h, w).cpu() / num_models
-        x_rec_mu += [x_reci_sum]
-        x_rec_sigma += [
-            torch.sqrt(
-                abs(x_reci_sum2.view(b, c, h, w).cpu() / num_models - x_reci_avg**2)
-            )
-        ]
-        z += [zi.cpu() / num_models]
+        x_rec_mu += [x_reci_moments.mean.view(b, c, h, w).cpu()]
+        x_rec_sigma += [x_reci_moments.var().view(b, c, h, w).cpu().sqrt()]
+        z += [zi_moments.mean.cpu()]
         labels += [yi]
 
     x = torch.cat(x, dim=0).numpy()
@@ -63,7 +83,6 @@ def inference_on_dataset(encoders, mu_decoders, val_loader, device):
 
 
 def inference_on_latent_grid(mu_decoders, z, device):
-    num_models = len(mu_decoders)
     if z.shape[1] != 2:
         return None, None, None, None
 
@@ -75,20 +94,11 @@ def inference_on_latent_grid(mu_decoders, z, device):
     for z_grid in tqdm(z_grid_loader):
 
         z_grid = z_grid[0].to(device)
-        mu_rec_grid_sum, mu_rec_grid_sum2 = None, None
-        for m_idx in range(num_models):
-            with torch.inference_mode():
-                mu_rec_grid = mu_decoders[m_idx](z_grid)
-                if mu_rec_grid_sum is None:
-                    mu_rec_grid_sum = mu_rec_grid
-                    mu_rec_grid_sum2 = mu_rec_grid**2
-                else:
-                    mu_rec_grid_sum += mu_rec_grid
-                    mu_rec_grid_sum2 += mu_rec_grid**2
-        mu_rec_grid_avg = mu_rec_grid_sum / num_models
-        sigma_rec_grid = torch.sqrt(
-            abs(mu_rec_grid_sum2 / num_models - mu_rec_grid_avg**2)
-        )
+        moments = RunningMoments()
+        with torch.inference_mode():
+            moments.update_batch(mu_decoders(z_grid))
+        mu_rec_grid = moments.mean
+        sigma_rec_grid = moments.var().sqrt()
 
         all_f_mu += [mu_rec_grid.cpu()]
         all_f_sigma += [sigma_rec_grid.cpu()]
@@ -113,20 +123,49 @@ def compute_likelihood(x, x_rec, sigma_rec):
     return likelihood.reshape(-1, 1)
 
 
+def member_config(config, version):
+    # the same experiment names as trainer_ae.py --version
+    config = deepcopy(config)
+    config["exp_name"] = f"{config['exp_name']}/{version}"
+    config["exp_name"] = create_exp_name(config)
+    return config
+
+
+def member_path(config):
+    return f"{config['dataset']}/ae_[use_var_dec={config['use_var_decoder']}]/{config['exp_name']}"
+
+
+def train_member(config, version, n_threads):
+    import pytorch_lightning as pl
+    from trainer_ae import train_ae
+
+    # each member gets its own seed (initialization and data order)
+    pl.seed_everything(config.get("seed", 0) + version)
+    torch.set_num_threads(n_threads)
+
+    config = member_config(config, version)
+    train_ae(config)
+    return member_path(config)
+
+
+def train_ensemble(config):
+    """trains the members of the ensemble in parallel processes"""
+    versions = config["versions"]
+    n_workers = min(config.get("n_workers", os.cpu_count()), len(versions))
+    n_threads = max(1, torch.get_num_threads() // n_workers)
+
+    with ProcessPoolExecutor(n_workers, mp_context=get_context("spawn")) as executor:
+        futures = [executor.submit(train_member, config, v, n_threads) for v in versions]
+        for future in futures:
+            print(f"==> trained {future.result()}")
+
+
 def test_ae_ensemble(config):
 
     # initialize_model
     device = "cuda:0" if torch.cuda.is_available() else "cpu"
     versions = config["versions"]
-    for v in versions:
-        config_v = deepcopy(config)
-        config_v["exp_name"] = f"{config_v['exp_name']}/{v}"
-        config_v["exp_name"] = create_exp_name(config_v)
-        paths.append()
-    paths = [
-        f"{config['dataset']}/ae_[use_var_dec={config['use_var_decoder']}]/{config['exp_name']}"
-        for v in versions
-    ]
+    paths = [member_path(member_config(config, v)) for v in versions]
 
     latent_size = config["latent_size"]
     encoders, mu_decoders = [], []
@@ -140,7 +179,11 @@ def test_ae_ensemble(config):
         encoders.append(encoder)
         mu_decoders.append(mu_decoder)
 
-    train_loader, val_loader = get_data(config["dataset"], config["batch_size"])
+    encoders, mu_decoders = StackedEnsemble(encoders), StackedEnsemble(mu_decoders)
+
+    train_loader, val_loader = get_data(
+        config["dataset"], config["batch_size"], cached=config.get("cached_data", False)
+    )
 
     # forward eval
     x, z, x_rec_mu, x_rec_sigma, labels = inference_on_dataset(
@@ -163,7 +206,11 @@ def test_ae_ensemble(config):
 
     plot_reconstructions(path, x, x_rec_mu, x_rec_sigma)
     if config["ood"]:
-        _, ood_val_loader = get_data(config["ood_dataset"], config["batch_size"])
+        _, ood_val_loader = get_data(
+            config["ood_dataset"],
+            config["batch_size"],
+            cached=config.get("cached_data", False),
+        )
 
         (
             ood_x,
@@ -233,4 +280,8 @@ if __name__ == "__main__":
 
     print(json.dumps(config, indent=4))
 
+    # train the members of the ensemble
+    if config.get("train", False):
+        train_ensemble(config)
+
     test_ae_ensemble(config)
@@ -1,7 +1,8 @@
 
 import os
 from laplace.onlinelaplace import OnlineLaplace
-from laplace.posthoclaplace import PosthocLaplace
+from laplace.posthoclaplace import PosthocLaplace, shard_loader
+from laplace.samplebank import sample_bank_header, sample_from_bank
 
 import torch
 from torch import nn
@@ -17,6 +18,7 @@ from datetime import datetime
 from data import get_data, generate_latent_grid
 from models import get_encoder, get_decoder
 from torch.nn.utils import parameters_to_vector, vector_to_parameters
+from torch.func import functional_call, vmap
 from copy import deepcopy
 import torchvision
 import torch.nn.functional as F
@@ -33,7 +35,7 @@ from visualizer import (
     plot_calibration_plot,
 )
 import numpy as np
-from utils import create_exp_name, compute_typicality_score
+from utils import create_exp_name, compute_typicality_score, RunningMoments
 
 
 def get_model(encoder, decoder):
@@ -108,6 +110,11 @@ class LitLaplaceAutoEncoder(pl.LightningModule):
         )
         self.log("time/compute_hessian", self.la.timings["compute_hessian"])
         self.log("time/forward_nn", self.la.timings["forward_nn"])
+        self.log("time/wait_hessian", self.la.timings["wait_hessian"])
+        if self.la.hessian_change is not None:
+            self.log("hessian/relative_change", self.la.hessian_change)
+        if self.la.hessian_profiler is not None:
+            self.log_dict(self.la.hessian_profiler.summary())
 
         # log images
         if self.current_epoch > self.last_epoch_logged:
@@ -185,15 +192,32 @@ class LitLaplaceAutoEncoder(pl.LightningModule):
             self.last_epoch_logged_val += 1
 
 
-def inference_on_dataset(net, samples, val_loader, latent_dim, last_layer):
-    device = net[-1].weight.device
+def sampled_forward(net, samples, x, latent_dim, last_layer):
+    """Evaluates the net for all the (stacked) sampled parameters at once,
+    returns the latents [n_samples, B, latent] and the reconstructions
+    [n_samples, B, ...]"""
+    params = dict(net.named_parameters())
+    names = list(params.keys())[-2:] if last_layer else list(params.keys())
+    sizes = [params[name].numel() for name in names]
+    sampled_params = {
+        name: sample.reshape(-1, *params[name].shape)
+        for name, sample in zip(names, samples.split(sizes, dim=1))
+    }
+    encoder, decoder = net[:latent_dim], net[latent_dim:]
+
+    def forward(sampled_param):
+        param = {**params, **sampled_param}
+        z = functional_call(encoder, {n: param[n] for n, _ in encoder.named_parameters()}, (x,))
+        x_rec = functional_call(decoder, {n: param[n] for n, _ in decoder.named_parameters()}, (z,))
+        return z, x_rec
 
-    z_i = []
+    return vmap(forward)(sampled_params)
 
-    def fw_hook_get_latent(module, input, output):
-        z_i.append(output.detach().cpu())
 
-    hook = net[latent_dim - 1].register_forward_hook(fw_hook_get_latent)
+def inference_on_dataset(net, samples, val_loader, latent_dim, last_layer=False, sample_batch_size=None):
+    device = net[-1].weight.device
+    n_samples = len(samples)
+    sample_batch_size = sample_batch_size or n_samples
 
     x, z_mu, z_sigma, x_rec_mu = [], [], [], []
     x_rec_sigma, labels, mse, likelihood = [], [], [], []
@@ -201,38 +225,21 @@ def inference_on_dataset(net, samples, val_loader, latent_dim, last_layer):
         xi = xi.to(device)
         with torch.inference_mode():
 
-            x_reci = None
-            x_reci_2 = None
-            z_i = []
-            likelihood_running_sum = 0
-
-            for net_sample in samples:
-
-                # replace the network parameters with the sampled parameters
-                if last_layer:
-                    vector_to_parameters(net_sample, list(net.parameters())[-2:])
-                else:
-                    vector_to_parameters(net_sample, net.parameters())
-                x_rec = net(xi)
+            # moments over the network samples, per image
+            z_moments, x_rec_moments, likelihood_sum = RunningMoments(), RunningMoments(), 0
+            for samples_j in samples.split(sample_batch_size):
+                z_j, x_rec_j = sampled_forward(net, samples_j, xi, latent_dim, last_layer)
 
-                if x_reci is None:
-                    x_reci = x_rec
-                    x_reci_2 = x_rec**2
-                else:
-                    x_reci += x_rec
-                    x_reci_2 += x_rec**2
+                z_moments.update_batch(z_j)
+                x_rec_moments.update_batch(x_rec_j)
+                likelihood_sum += (
+                    (x_rec_j.view(len(samples_j), *xi.shape) - xi) ** 2
+                ).flatten(start_dim=2).sum(dim=(0, 2))
 
-                likelihood_running_sum += F.mse_loss(
-                    x_rec.view(*xi.shape), xi, reduction="sum"
-                )
-
-            z_i = torch.cat(z_i)
-
-            # ave[[rage over network samples
-            x_reci_mu = x_reci / len(samples)
-            x_reci_sigma = abs(x_reci_2 / len(samples) - x_reci_mu**2 + 1e-5).sqrt()
-            z_i_mu = torch.mean(z_i, dim=0)
-            z_i_sigma = abs(torch.var(z_i, dim=0) + 1e-5).sqrt()
+            x_reci_mu = x_rec_moments.mean
+            x_reci_sigma = (x_rec_moments.var() + 1e-5).sqrt()
+            z_i_mu = z_moments.mean
+            z_i_sigma = (z_moments.var(unbiased=True) + 1e-5).sqrt()
 
             # append to list
             x_rec_mu += [x_reci_mu]
@@ -242,96 +249,62 @@ def inference_on_dataset(net, samples, val_loader, latent_dim, last_layer):
             labels += [yi]
             x += [xi]
 
-            mse += [F.mse_loss(x_reci_mu.view(*xi.shape), xi, reduction="sum")]
-            likelihood += [likelihood_running_sum / len(samples)]
+            mse += [((x_reci_mu.view(*xi.shape) - xi) ** 2).flatten(start_dim=1).sum(dim=1)]
+            likelihood += [likelihood_sum / n_samples]
 
     x = torch.cat(x, dim=0).cpu().numpy()
     labels = torch.cat(labels, dim=0).numpy()
-    z_mu = torch.stack(z_mu).cpu().numpy()
-    z_sigma = torch.stack(z_sigma).cpu().numpy()
+    z_mu = torch.cat(z_mu).cpu().numpy()
+    z_sigma = torch.cat(z_sigma).cpu().numpy()
     x_rec_mu = torch.cat(x_rec_mu).cpu().numpy()
     x_rec_sigma = torch.cat(x_rec_sigma).cpu().numpy()
-    mse = torch.stack(mse).cpu().numpy()
-    likelihood = torch.stack(likelihood).cpu().numpy().reshape(-1, 1)
-
-    # remove forward hook
-    hook.remove()
+    mse = torch.cat(mse).cpu().numpy()
+    likelihood = torch.cat(likelihood).cpu().numpy().reshape(-1, 1)
 
     return x, z_mu, z_sigma, x_rec_mu, x_rec_sigma, labels, mse, likelihood
 
 
-def inference_on_latent_grid(net_original, samples, z_mu, latent_dim, dummy, last_layer):
+def inference_on_latent_grid(net, samples, z_mu, latent_dim, last_layer, batch_size=2500):
 
     if z_mu.shape[1] != 2:
         return None, None, None, None
 
-    device = net_original[-1].weight.device
-    dummy = dummy[0:1]
+    device = net[-1].weight.device
+
+    # only the decoder is evaluated, on the grid points directly
+    decoder = net[latent_dim:]
+    mu_q = parameters_to_vector(net.parameters())
 
     # Grid for probability map
     n_points_axis = 50
-    xg_mesh, yg_mesh, z_grid_loader = generate_latent_grid(z_mu, n_points_axis)
-
-    # the hook signature that just replaces the current
-    # feature map with the given point
-    def modify_input(z_grid):
-        def hook(module, input):
-            input[0][:] = z_grid[0]
-
-        return hook
-
-    all_f_mu, all_f_sigma = [], []
-    for i, z_grid in enumerate(tqdm(z_grid_loader)):
-
-        z_grid = z_grid[0].to(device)
-
-        assert dummy.shape[0] == z_grid.shape[0]
-
-        net = deepcopy(net_original)
-        replace_hook = net[latent_dim].register_forward_pre_hook(modify_input(z_grid))
-
-        with torch.inference_mode():
-
-            pred = None
-            pred2 = None
-
-            for net_sample in samples:
-
-                # replace the network parameters with the sampled parameters
-                if last_layer:
-                    vector_to_parameters(net_sample, list(net.parameters())[-2:])
-                else:
-                    vector_to_parameters(net_sample, net.parameters())
-                x_rec = net(dummy).detach()
+    xg_mesh, yg_mesh, z_grid_loader = generate_latent_grid(
+        z_mu, n_points_axis, batch_size=batch_size
+    )
 
-                if pred is None:
-                    pred = x_rec
-                    pred2 = x_rec**2
-                else:
-                    pred += x_rec
-                    pred2 += x_rec**2
+    # moments over the weight samples, one batch of the grid at a time
+    moments = RunningMoments()
+    with torch.inference_mode():
+        for net_sample in tqdm(samples):
 
-            mu_rec_grid = pred.cpu() / len(samples)
-            sigma_rec_grid = pred2.cpu() / len(samples) - mu_rec_grid**2
-            sigma_rec_grid = abs(sigma_rec_grid + 1e-5).sqrt()
+            # replace the network parameters with the sampled parameters
+            if last_layer:
+                vector_to_parameters(net_sample, list(net.parameters())[-2:])
+            else:
+                vector_to_parameters(net_sample, net.parameters())
 
-        all_f_mu += [mu_rec_grid]
-        all_f_sigma += [sigma_rec_grid]
-        replace_hook.remove()
+            moments.update(torch.cat([decoder(z_grid[0].to(device)) for z_grid in z_grid_loader]))
 
-    f_mu = torch.stack(all_f_mu)
-    f_sigma = torch.stack(all_f_sigma)
+        vector_to_parameters(mu_q, net.parameters())
 
-    # average over samples
-    sigma_vector = np.reshape(f_sigma, (n_points_axis * n_points_axis, -1)).mean(axis=1)
+    f_sigma = (moments.var().cpu() + 1e-5).sqrt()
 
     # average over diagonal elements
-    sigma_vector = sigma_vector.view(n_points_axis**2, -1).mean(axis=1)
+    sigma_vector = f_sigma.reshape(n_points_axis**2, -1).mean(axis=1)
 
     return xg_mesh, yg_mesh, sigma_vector, n_points_axis
 
 
-def test_lae(config, batch_size=1):
+def test_lae(config, batch_size=128):
 
     # initialize_model
     device = "cuda:0" if torch.cuda.is_available() else "cpu"
@@ -346,17 +319,32 @@ def test_lae(config, batch_size=1):
     net.load_state_dict(torch.load(f"../weights/{path}/net.pth"))
     print(f"==> load weights from ../weights/{path}/net.pth")
 
+    # older checkpoints store the prior precision separately
     if os.path.isfile(f"../weights/{path}/prior_prec.pth"):
         prior_prec = torch.load(f"../weights/{path}/prior_prec.pth")
         config["prior_precision"] = prior_prec
 
     train_loader, val_loader = get_data(
-        config["dataset"], batch_size
+        config["dataset"], batch_size, cached=config.get("cached_data", False)
     )
 
     la = OnlineLaplace(net, len(val_loader.dataset), config, register_forward_hook=False)
     la.load_hessian(f"../weights/{path}/hessian.pth")
-    samples = la.sample(n_samples=config["test_samples"], last_layer=False)
+
+    # repeated evaluations share the samples of the bank
+    header = sample_bank_header(
+        net,
+        la.hessian,
+        la.prior_prec,
+        la.hessian_scale,
+        config["seed"] if "seed" in config else 0,
+        config["test_samples"],
+    )
+    samples = sample_from_bank(
+        f"../weights/{path}/samples.bank",
+        header,
+        lambda: la.sample(n_samples=config["test_samples"], last_layer=False),
+    ).to(device)
 
     # evaluate on dataset
     (
@@ -376,7 +364,6 @@ def test_lae(config, batch_size=1):
         samples,
         z_mu,
         latent_dim,
-        torch.zeros(*x.shape, device=device),
         last_layer=False
     )
 
@@ -400,7 +387,9 @@ def test_lae(config, batch_size=1):
     # evaluate on OOD dataset
     if config["ood"]:
         
-        _, ood_val_loader = get_data(config["ood_dataset"], batch_size)
+        _, ood_val_loader = get_data(
+            config["ood_dataset"], batch_size, cached=config.get("cached_data", False)
+        )
 
         (
             ood_x,
@@ -450,7 +439,9 @@ def train_lae(config):
 
     # data
     train_loader, val_loader = get_data(
-        config["dataset"], batch_size=config["batch_size"]
+        config["dataset"],
+        batch_size=config["batch_size"],
+        cached=config.get("cached_data", False),
     )
 
     # model
@@ -479,6 +470,10 @@ def train_lae(config):
     model.la.save_hessian(f"../weights/{path}/hessian.pth")
     print(f"==> save weights from ../weights/{path}/net.pth")
 
+    # per layer trace of the hessian sweeps of the last training step
+    if model.la.hessian_profiler is not None:
+        model.la.hessian_profiler.save_chrome_trace(f"../weights/{path}/hessian_trace.json")
+
     with open(f"../weights/{path}/config.yaml", "w") as outfile:
         yaml.dump(config, outfile, default_flow_style=False)
 
@@ -489,11 +484,13 @@ def log_likelihood(loss, n_data, n_output):
     return -loss - c
 
 
-def fit_lae(config):
+def fit_lae(config, shard=-1):
 
     # data
     train_loader, val_loader = get_data(
-        config["dataset"], batch_size=config["batch_size"]
+        config["dataset"],
+        batch_size=config["batch_size"],
+        cached=config.get("cached_data", False),
     )
 
     device = (
@@ -524,20 +521,46 @@ def fit_lae(config):
     net.eval()
 
     la = PosthocLaplace(net, approx = config["approximation"], classification=True)
-    la.fit(train_loader)
-    la.optimize_precision()
 
-    # save weights
+    # the partial hessians are checkpointed, so a crashed fit can be resumed
     path = f"{config['dataset']}/lae_posthoc/{config['exp_name']}"
     os.makedirs(f"../weights/{path}", exist_ok=True)
+    n_shards = config["n_shards"] if "n_shards" in config else 1
+    checkpoints = [
+        f"../weights/{path}/hessian_shard_{i}_of_{n_shards}.pth" for i in range(n_shards)
+    ]
+
+    # the shards can be fitted in separate processes with --shard
+    # and each shard data parallel over n_workers cpu processes
+    n_workers = config["n_workers"] if "n_workers" in config else 1
+    shards = range(n_shards) if shard < 0 else [shard]
+    for i in shards:
+        la.fit(
+            shard_loader(train_loader, i, n_shards),
+            checkpoint_path=checkpoints[i],
+            n_workers=n_workers,
+        )
+    if shard >= 0:
+        return
+
+    la.reduce(checkpoints)
+    # with per_layer_prior, one prior precision per layer of the net
+    la.optimize_precision(per_layer=config["per_layer_prior"] if "per_layer_prior" in config else False)
+
+    # save weights, the prior precision is stored with the hessian
     torch.save(net.state_dict(), f"../weights/{path}/net.pth")
-    torch.save(la.hessian, f"../weights/{path}/hessian.pth")
-    torch.save(la.prior_prec, f"../weights/{path}/prior_prec.pth")
+    torch.save(
+        {"hessian": la.hessian, "prior_prec": la.prior_prec},
+        f"../weights/{path}/hessian.pth",
+    )
     print(f"==> save weights to ../weights/{path}/net.pth")
 
     with open(f"../weights/{path}/config.yaml", "w") as outfile:
         yaml.dump(config, outfile, default_flow_style=False)
 
+    for checkpoint in checkpoints:
+        os.remove(checkpoint)
+
 
 if __name__ == "__main__":
 
@@ -554,6 +577,12 @@ if __name__ == "__main__":
         default=-1,
         help="version (-1 is ignored)",
     )
+    parser.add_argument(
+        "--shard",
+        type=int,
+        default=-1,
+        help="only fit this shard of the posthoc hessian (-1 fits all and reduces)",
+    )
     args = parser.parse_args()
 
     with open(args.config) as file:
@@ -572,6 +601,10 @@ if __name__ == "__main__":
 
     # fit laplace approximation post-hoc
     elif config["train"] and config["posthoc"]:
-        fit_lae(config)
+        fit_lae(config, args.shard)
+
+        # the remaining shards and the reduction are done by another call
+        if args.shard >= 0:
+            exit()
 
     test_lae(config)
@@ -4,7 +4,6 @@ import numpy as np
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, TensorDataset
 from tqdm import tqdm
 import torch.nn.functional as F
 import time
@@ -29,7 +28,7 @@ from utils import create_exp_name, compute_typicality_score
 #from laplace2.laplace2 import Laplace
 
 # from laplace import Laplace
-from data import get_data, generate_latent_grid
+from data import get_data, generate_latent_grid, TensorBatchLoader
 from models import get_encoder, get_decoder
 from utils import save_laplace, load_laplace
 import yaml
@@ -112,10 +111,12 @@ def inference_on_latent_grid(la_original, encoder, z_mu, latent_dim, device):
     n_points_axis = 50
     xg_mesh, yg_mesh, z_grid_loader = generate_latent_grid(z_mu, n_points_axis)
 
+    # one copy for the whole grid, the predictions may change the state of la
+    la = deepcopy(la_original)
+
     all_f_mu, all_f_sigma = [], []
     for z_grid in tqdm(z_grid_loader):
 
-        la = deepcopy(la_original)
         z_grid = z_grid[0].to(device)
 
         with torch.inference_mode():
@@ -165,9 +166,14 @@ def test_lae_decoder(config):
     latent_dim = len(encoder.encoder) - 1
     encoder.load_state_dict(torch.load(f"../weights/{path}/encoder.pth"))
 
-    la = load_laplace(f"../weights/{path}/decoder.pkl")
+    la = load_laplace(
+        f"../weights/{path}/decoder.ckpt",
+        get_laplace(get_flatten_decoder(config, config["latent_size"]).decoder, config),
+    )
 
-    train_loader, val_loader = get_data(config["dataset"], config["batch_size"])
+    train_loader, val_loader = get_data(
+        config["dataset"], config["batch_size"], cached=config.get("cached_data", False)
+    )
 
     # create figures
     os.makedirs(f"../figures/{path}", exist_ok=True)
@@ -195,7 +201,11 @@ def test_lae_decoder(config):
 
     if config["ood"]:
 
-        _, ood_val_loader = get_data(config["ood_dataset"], config["batch_size"])
+        _, ood_val_loader = get_data(
+            config["ood_dataset"],
+            config["batch_size"],
+            cached=config.get("cached_data", False),
+        )
 
         ood_x, _, _, _, ood_x_rec_mu, ood_x_rec_sigma, _, _ = inference_on_dataset(
             la, encoder, ood_val_loader, latent_dim, device
@@ -248,9 +258,14 @@ def test_lae_encoder_decoder(config):
     encoder = get_encoder(config, config["latent_size"]).eval().to(device)
     latent_dim = len(encoder.encoder) - 1
 
-    la = load_laplace(f"../weights/{path}/ae.pkl")
+    la = load_laplace(
+        f"../weights/{path}/ae.ckpt",
+        get_laplace(get_model(encoder, get_flatten_decoder(config, config["latent_size"])), config),
+    )
 
-    train_loader, val_loader = get_data(config["dataset"], config["batch_size"])
+    train_loader, val_loader = get_data(
+        config["dataset"], config["batch_size"], cached=config.get("cached_data", False)
+    )
 
     # create figures
     os.makedirs(f"../figures/{path}", exist_ok=True)
@@ -270,7 +285,7 @@ def test_lae_encoder_decoder(config):
     save_metric(path, "mse", mse.sum())
 
     xg_mesh, yg_mesh, sigma_vector, n_points_axis = inference_on_latent_grid(
-        deepcopy(la), None, z_mu, latent_dim, device
+        la, None, z_mu, latent_dim, device
     )
 
     if config["dataset"] == "swissrole":
@@ -284,7 +299,11 @@ def test_lae_encoder_decoder(config):
     plot_reconstructions(path, x, x_rec_mu, x_rec_sigma)
 
     if config["ood"]:
-        _, ood_val_loader = get_data(config["ood_dataset"], config["batch_size"])
+        _, ood_val_loader = get_data(
+            config["ood_dataset"],
+            config["batch_size"],
+            cached=config.get("cached_data", False),
+        )
 
         (
             ood_x,
@@ -353,10 +372,49 @@ def test_lae(config):
         test_lae_decoder(config)
 
 
+# gather encoder and decoder into one model:
+def get_model(encoder, decoder):
+
+    net = deepcopy(encoder.encoder._modules)
+    decoder = decoder.decoder._modules
+    max_ = max([int(i) for i in net.keys()])
+    for i in decoder.keys():
+        net.update({f"{max_+int(i) + 1}": decoder[i]})
+
+    return nn.Sequential(net)
+
+
+def get_flatten_decoder(config, latent_size):
+
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    decoder = get_decoder(config, latent_size).eval().to(device)
+
+    layers = list(decoder.decoder)
+    layers.append(torch.nn.Flatten())
+    decoder.decoder = torch.nn.Sequential(*layers)
+
+    return decoder
+
+
+def get_laplace(net, config):
+    # the fitted laplace is stored as tensors only, so it is loaded into a
+    # laplace that is constructed the same way (see utils.load_laplace)
+    return Laplace(
+        net,
+        "regression",
+        hessian_structure=config["approximation"]
+        if "approximation" in config
+        else "diag",
+        subset_of_weights="all",
+    )
+
+
 def fit_laplace_to_decoder(encoder, decoder, config):
 
     device = "cuda:0" if torch.cuda.is_available() else "cpu"
-    train_loader, _ = get_data(config["dataset"], config["batch_size"])
+    train_loader, _ = get_data(
+        config["dataset"], config["batch_size"], cached=config.get("cached_data", False)
+    )
 
     # create dataset
     z, x = [], []
@@ -369,20 +427,11 @@ def fit_laplace_to_decoder(encoder, decoder, config):
     z = torch.cat(z, dim=0).cpu()
     x = torch.cat(x, dim=0).cpu()
 
-    z_loader = DataLoader(
-        TensorDataset(z, x), batch_size=config["batch_size"], pin_memory=True
-    )
+    z_loader = TensorBatchLoader(z, x, batch_size=config["batch_size"])
 
     # Laplace Approximation
     # la = Laplace(decoder, 'regression', subset_of_weights='last_layer', hessian_structure='diag')
-    la = Laplace(
-        decoder.decoder,
-        "regression",
-        hessian_structure=config["approximation"]
-        if "approximation" in config
-        else "diag",
-        subset_of_weights="all",
-    )
+    la = get_laplace(decoder.decoder, config)
 
     # Fitting
     la.fit(z_loader)
@@ -397,12 +446,14 @@ def fit_laplace_to_decoder(encoder, decoder, config):
     )
     path = f"../weights/{config['dataset']}/lae_post_hoc_[use_la_encoder=False]/{approx}{config['exp_name']}"
     os.makedirs(path, exist_ok=True)
-    save_laplace(la, f"{path}/decoder.pkl")
+    save_laplace(la, f"{path}/decoder.ckpt", config)
 
 
 def fit_laplace_to_enc_and_dec(encoder, decoder, config):
 
-    train_loader, _ = get_data(config["dataset"], config["batch_size"])
+    train_loader, _ = get_data(
+        config["dataset"], config["batch_size"], cached=config.get("cached_data", False)
+    )
 
     # create flatten dataset
     x, y = [], []
@@ -411,32 +462,10 @@ def fit_laplace_to_enc_and_dec(encoder, decoder, config):
         y += [X.view(X.size(0), -1)]
     y = torch.cat(y, dim=0)
     x = torch.cat(x, dim=0)
-    train_loader = DataLoader(
-        TensorDataset(x, y), batch_size=config["batch_size"], pin_memory=True
-    )
-
-    # gather encoder and decoder into one model:
-    def get_model(encoder, decoder):
-
-        net = deepcopy(encoder.encoder._modules)
-        decoder = decoder.decoder._modules
-        max_ = max([int(i) for i in net.keys()])
-        for i in decoder.keys():
-            net.update({f"{max_+int(i) + 1}": decoder[i]})
-
-        return nn.Sequential(net)
-
-    net = get_model(encoder, decoder)
+    train_loader = TensorBatchLoader(x, y, batch_size=config["batch_size"])
 
     # subnetwork Laplace where we specify subnetwork by module names
-    la = Laplace(
-        net,
-        "regression",
-        hessian_structure=config["approximation"]
-        if "approximation" in config
-        else "diag",
-        subset_of_weights="all",
-    )
+    la = get_laplace(get_model(encoder, decoder), config)
 
     # Fitting
     la.fit(train_loader)
@@ -451,7 +480,7 @@ def fit_laplace_to_enc_and_dec(encoder, decoder, config):
     )
     path = f"../weights/{config['dataset']}/lae_post_hoc_[use_la_encoder=True]/{approx}{config['exp_name']}"
     os.makedirs(path, exist_ok=True)
-    save_laplace(la, f"{path}/ae.pkl")
+    save_laplace(la, f"{path}/ae.ckpt", config)
 
 
 def train_lae(config):
@@ -460,11 +489,7 @@ def train_lae(config):
     latent_size = config["latent_size"]
     device = "cuda:0" if torch.cuda.is_available() else "cpu"
     encoder = get_encoder(config, latent_size).eval().to(device)
-    decoder = get_decoder(config, latent_size).eval().to(device)
-
-    layers = list(decoder.decoder)
-    layers.append(torch.nn.Flatten())
-    decoder.decoder = torch.nn.Sequential(*layers)
+    decoder = get_flatten_decoder(config, latent_size)
 
     # load model weights
     path = f"../weights/{config['dataset']}/ae_[use_var_dec=False]/{config['exp_name']}"
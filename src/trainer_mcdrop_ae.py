@@ -23,7 +23,7 @@ from visualizer import (
 )
 from datetime import datetime
 import json
-from utils import create_exp_name, compute_typicality_score
+from utils import create_exp_name, compute_typicality_score, RunningMoments
 import torchvision
 
 
@@ -82,21 +82,13 @@ class LitDropoutAutoEncoder(pl.LightningModule):
         apply_dropout(self.encoder)
         apply_dropout(self.decoder)
 
-        x_hat_running = None
-        x_hat2_running = None
+        moments = RunningMoments()
         for i in range(config["test_samples"]):
             z = self.encoder(x)
             x_hat = self.decoder(z)
+            moments.update(x_hat)
 
-            if x_hat_running is None:
-                x_hat_running = x_hat
-                x_hat2_running = x_hat**2
-            else:
-                x_hat_running += x_hat
-                x_hat2_running += x_hat**2
-
-        mu = x_hat_running / config["test_samples"]
-        mu2 = x_hat2_running / config["test_samples"]
+        mu = moments.mean
 
         loss = F.mse_loss(x_hat.view(*x.shape), x)
         self.log("val_loss", loss)
@@ -113,8 +105,7 @@ class LitDropoutAutoEncoder(pl.LightningModule):
                 "val/mean_recons_images", img_grid, self.current_epoch
             )
 
-            mu2 = mu2[:4].view(*x[:4].shape)
-            sigma = (mu2 - mu**2).abs().sqrt()
+            sigma = moments.var()[:4].view(*x[:4].shape).sqrt()
 
             img_grid = torch.clamp(torchvision.utils.make_grid(sigma), 0, 1)
             self.logger.experiment.add_image(
@@ -135,35 +126,20 @@ def inference_on_dataset(encoder, decoder, val_loader, N, device):
             apply_dropout(encoder)
             apply_dropout(decoder)
 
-            mu_z_i, mu2_z_i, mu_rec_i, mu2_rec_i = None, None, None, None
+            z_moments, x_rec_moments = RunningMoments(), RunningMoments()
             for n in range(N):
 
                 zi = encoder(xi)
                 x_reci = decoder(zi)
 
                 # compute running mean and running variance
-                if mu_rec_i is None:
-                    mu_rec_i = x_reci
-                    mu2_rec_i = x_reci**2
-                    mu_z_i = zi
-                    mu2_z_i = zi**2
-                else:
-                    mu_rec_i += x_reci
-                    mu2_rec_i += x_reci**2
-                    mu_z_i += zi
-                    mu2_z_i += zi**2
-
-            mu_rec_i = mu_rec_i / N
-            mu2_rec_i = mu2_rec_i / N
-
-            # add abs for numerical stability
-            sigma_rec_i = (mu2_rec_i - mu_rec_i**2).abs().sqrt()
+                z_moments.update(zi)
+                x_rec_moments.update(x_reci)
 
-            mu_z_i = mu_z_i / N
-            mu2_z_i = mu2_z_i / N
-
-            # add abs for numerical stability
-            sigma_z_i = (mu2_z_i - mu_z_i**2).abs().sqrt()
+            mu_rec_i = x_rec_moments.mean
+            sigma_rec_i = x_rec_moments.var().sqrt()
+            mu_z_i = z_moments.mean
+            sigma_z_i = z_moments.var().sqrt()
 
             x += [xi.cpu()]
             z_mu += [mu_z_i.detach().cpu()]
@@ -197,30 +173,18 @@ def inference_on_latent_grid(decoder, z_mu, N, device):
 
         z_grid = z_grid[0].to(device)
 
-        mu_rec_grid, mu2_rec_grid = None, None
+        moments = RunningMoments()
         with torch.inference_mode():
 
             # enable dropout
             apply_dropout(decoder)
 
-            # take N mc samples
+            # take N mc samples, compute running mean and variance
             for n in range(N):
+                moments.update(decoder(z_grid))
 
-                x_recn = decoder(z_grid)
-
-                # compute running mean and variance
-                if mu_rec_grid is None:
-                    mu_rec_grid = x_recn
-                    mu2_rec_grid = x_recn**2
-                else:
-                    mu_rec_grid += x_recn
-                    mu2_rec_grid += x_recn**2
-
-        mu_rec_grid = mu_rec_grid / N
-        mu2_rec_grid = mu2_rec_grid / N
-
-        # add abs for numerical stability
-        sigma_rec_grid = (mu2_rec_grid - mu_rec_grid**2).abs().sqrt()
+        mu_rec_grid = moments.mean
+        sigma_rec_grid = moments.var().sqrt()
 
         all_f_mu += [mu_rec_grid.cpu()]
         all_f_sigma += [sigma_rec_grid.cpu()]
@@ -260,7 +224,9 @@ def test_mcdropout_ae(config):
     )
     decoder.load_state_dict(torch.load(f"../weights/{path}/decoder.pth"))
 
-    train_loader, val_loader = get_data(config["dataset"], config["batch_size"])
+    train_loader, val_loader = get_data(
+        config["dataset"], config["batch_size"], cached=config.get("cached_data", False)
+    )
 
     # number of mc samples
     N = config["test_samples"]
@@ -285,7 +251,11 @@ def test_mcdropout_ae(config):
 
     plot_reconstructions(path, x, x_rec_mu, x_rec_sigma)
     if config["ood"]:
-        _, ood_val_loader = get_data(config["ood_dataset"], config["batch_size"])
+        _, ood_val_loader = get_data(
+            config["ood_dataset"],
+            config["batch_size"],
+            cached=config.get("cached_data", False),
+        )
 
         (
             ood_x,
@@ -343,7 +313,9 @@ def test_mcdropout_ae(config):
 def train_mcdropout_ae(config):
 
     # data
-    train_loader, val_loader = get_data(config["dataset"])
+    train_loader, val_loader = get_data(
+        config["dataset"], cached=config.get("cached_data", False)
+    )
 
     # model
     model = LitDropoutAutoEncoder(config)
@@ -23,7 +23,7 @@ from visualizer import (
 from datetime import datetime
 import json
 import torchvision
-from utils import create_exp_name, compute_typicality_score
+from utils import create_exp_name, compute_typicality_score, RunningMoments
 
 
 class LitVariationalAutoEncoder(pl.LightningModule):
@@ -181,24 +181,17 @@ def inference_on_dataset(
                 # number of mc samples
                 N = 30
 
-                mu_rec_i, mu2_rec_i = None, None
+                moments = RunningMoments()
                 for n in range(N):
 
                     # sample from distribution
                     zi = z_mu_i + torch.randn_like(z_sigma_i) * z_sigma_i
-                    x_reci = mu_decoder(zi)
 
                     # compute running mean and running variance
-                    if mu_rec_i is None:
-                        mu_rec_i = x_reci
-                        mu2_rec_i = x_reci**2
-                    else:
-                        mu_rec_i += x_reci
-                        mu2_rec_i += x_reci**2
+                    moments.update(mu_decoder(zi))
 
-                mu_rec_i = mu_rec_i / N
-                mu2_rec_i = mu2_rec_i / N
-                sigma_rec_i = (mu2_rec_i - mu_rec_i**2) ** 0.5
+                mu_rec_i = moments.mean
+                sigma_rec_i = moments.var() ** 0.5
 
             x += [xi.cpu()]
             z_mu += [z_mu_i.detach().cpu()]
@@ -295,7 +288,9 @@ def test_vae(config):
     else:
         var_decoder = None
 
-    train_loader, val_loader = get_data(config["dataset"], config["batch_size"])
+    train_loader, val_loader = get_data(
+        config["dataset"], config["batch_size"], cached=config.get("cached_data", False)
+    )
 
     # forward eval
     x, z_mu, z_sigma, x_rec_mu, x_rec_sigma, labels = inference_on_dataset(
@@ -318,7 +313,11 @@ def test_vae(config):
 
     plot_reconstructions(path, x, x_rec_mu, x_rec_sigma)
     if config["ood"]:
-        _, ood_val_loader = get_data(config["ood_dataset"], config["batch_size"])
+        _, ood_val_loader = get_data(
+            config["ood_dataset"],
+            config["batch_size"],
+            cached=config.get("cached_data", False),
+        )
 
         (
             ood_x,
@@ -394,7 +393,9 @@ def test_vae(config):
 def train_vae(config):
 
     # data
-    train_loader, val_loader = get_data(config["dataset"])
+    train_loader, val_loader = get_data(
+        config["dataset"], cached=config.get("cached_data", False)
+    )
 
     # model
     model = LitVariationalAutoEncoder(config)
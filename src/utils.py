@@ -1,5 +1,9 @@
+import importlib
+import json
+import os
+import warnings
+import torch
 import torch.nn.functional as F
-import dill
 import numpy as np
 
 
@@ -10,14 +14,143 @@ def softclip(tensor, min):
     return result_tensor
 
 
-def save_laplace(la, filepath):
-    with open(filepath, "wb") as outpt:
-        dill.dump(la, outpt)
-
-
-def load_laplace(filepath):
-    with open(filepath, "rb") as inpt:
-        la = dill.load(inpt)
+# tensor checkpoints: 8 byte little endian header length, json header padded
+# to TENSOR_ALIGNMENT bytes, then the raw bytes of the tensors, each aligned
+TENSOR_ALIGNMENT = 64
+
+# the only classes that a checkpoint may instantiate: the kronecker factors of
+# laplace-torch (laplace2 is its renamed copy, see trainer_lae_posthoc) and
+# the hessian structures of this repo
+CHECKPOINT_CLASSES = {
+    f"{package}.{module}.{name}"
+    for package in ("laplace", "laplace2")
+    for module in ("matrix", "utils.matrix")
+    for name in ("Kron", "KronDecomposed")
+} | {
+    f"laplace.laplace.{name}"
+    for name in ("DiagLaplace", "BlockLaplace", "LowRankLaplace", "KronLaplace")
+}
+
+
+def class_name(obj):
+    return f"{type(obj).__module__}.{type(obj).__qualname__}"
+
+
+def _encode(tree, tensors):
+    """json-able tree, the tensors are replaced by their index in tensors"""
+    if torch.is_tensor(tree):
+        tensors.append(tree.detach().cpu().contiguous())
+        return {"__tensor__": len(tensors) - 1}
+    if isinstance(tree, dict):
+        return {"__dict__": [[k, _encode(v, tensors)] for k, v in tree.items()]}
+    if isinstance(tree, (list, tuple)):
+        return {"__list__" if isinstance(tree, list) else "__tuple__": [_encode(v, tensors) for v in tree]}
+    if tree is None or isinstance(tree, (bool, int, float, str)):
+        return tree
+    # plain objects (e.g. kronecker factors) are stored by their attributes
+    if class_name(tree) not in CHECKPOINT_CLASSES:
+        raise ValueError(f"{class_name(tree)} can't be stored in a tensor checkpoint")
+    return {"__object__": class_name(tree), "state": _encode(vars(tree), tensors)}
+
+
+def _decode(tree, tensors):
+    if not isinstance(tree, dict):
+        return tree
+    if "__tensor__" in tree:
+        return tensors[tree["__tensor__"]]
+    if "__dict__" in tree:
+        return {k: _decode(v, tensors) for k, v in tree["__dict__"]}
+    if "__list__" in tree:
+        return [_decode(v, tensors) for v in tree["__list__"]]
+    if "__tuple__" in tree:
+        return tuple(_decode(v, tensors) for v in tree["__tuple__"])
+    # never import or instantiate a class that the checkpoint names otherwise
+    if tree["__object__"] not in CHECKPOINT_CLASSES:
+        raise ValueError(f"checkpoint object {tree['__object__']} is not in CHECKPOINT_CLASSES")
+    module, name = tree["__object__"].rsplit(".", 1)
+    obj = object.__new__(getattr(importlib.import_module(module), name))
+    obj.__dict__.update(_decode(tree["state"], tensors))
+    return obj
+
+
+def encodable(value):
+    """whether value can be stored in a tensor checkpoint"""
+    if isinstance(value, torch.nn.Module) or callable(value):
+        return False
+    if isinstance(value, dict):
+        return all(encodable(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return all(encodable(v) for v in value)
+    if torch.is_tensor(value) or value is None or isinstance(value, (bool, int, float, str)):
+        return True
+    return class_name(value) in CHECKPOINT_CLASSES and encodable(vars(value))
+
+
+def save_tensors(filepath, tree):
+    """stores a tree of dicts, lists and tuples of tensors and scalars"""
+    tensors = []
+    header = {"tree": _encode(tree, tensors), "tensors": []}
+    offset = 0
+    for t in tensors:
+        offset += -offset % TENSOR_ALIGNMENT
+        nbytes = t.numel() * t.element_size()
+        header["tensors"] += [{"dtype": str(t.dtype)[6:], "shape": list(t.shape), "offset": offset}]
+        offset += nbytes
+
+    header = json.dumps(header).encode()
+    header += b" " * (-(8 + len(header)) % TENSOR_ALIGNMENT)
+
+    # written to a temporary file first, so a crash never leaves a partial checkpoint
+    with open(f"{filepath}.tmp", "wb") as f:
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        start = f.tell()
+        for t, info in zip(tensors, json.loads(header)["tensors"]):
+            f.write(b"\0" * (start + info["offset"] - f.tell()))
+            f.write(t.view(-1).view(torch.uint8).numpy().tobytes() if t.numel() > 0 else b"")
+    os.replace(f"{filepath}.tmp", filepath)
+
+
+def load_tensors(filepath):
+    """loads the tree of a tensor checkpoint, the tensors are memory mapped
+    views (copy on write) into the file, so loading only reads the header"""
+    with open(filepath, "rb") as f:
+        header_length = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_length))
+
+    data = torch.from_numpy(np.memmap(filepath, dtype=np.uint8, mode="c", offset=8 + header_length)) \
+        if os.path.getsize(filepath) > 8 + header_length else torch.zeros(0, dtype=torch.uint8)
+    tensors = []
+    for info in header["tensors"]:
+        dtype = getattr(torch, info["dtype"])
+        nbytes = int(np.prod(info["shape"])) * torch.tensor([], dtype=dtype).element_size()
+        t = data[info["offset"] : info["offset"] + nbytes].view(dtype).view(info["shape"])
+        tensors.append(t)
+    return _decode(header["tree"], tensors)
+
+
+def save_laplace(la, filepath, config=None):
+    """stores the network state, the tensor state (hessian, prior precision,
+    ...) and the config of a fitted laplace as a tensor checkpoint. The modules
+    and callables are rebuilt by the constructor (see load_laplace), any other
+    attribute that can't be stored is reported."""
+    state = {k: v for k, v in vars(la).items() if encodable(v)}
+    dropped = [
+        k
+        for k, v in vars(la).items()
+        if k not in state and not isinstance(v, torch.nn.Module) and not callable(v)
+    ]
+    if dropped:
+        warnings.warn(f"save_laplace can't store the attributes {dropped}, they are not saved")
+    save_tensors(filepath, {"model": la.model.state_dict(), "state": state, "config": config})
+
+
+def load_laplace(filepath, la):
+    """restores a laplace saved with save_laplace into la, that is constructed
+    the same way as the saved one (model architecture, likelihood, structure)"""
+    checkpoint = load_tensors(filepath)
+    la.model.load_state_dict(checkpoint["model"])
+    la.__dict__.update(checkpoint["state"])
     return la
 
 
@@ -40,6 +173,51 @@ def create_exp_name(config, exclude=[]):
     return name
 
 
+class RunningMoments:
+    """Streaming mean and variance over samples (Welford), the partial moments
+    of different chunks or workers merge exactly (Chan et al.)"""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x):
+        """add a single sample x"""
+        self.n += 1
+        if self.mean is None:
+            self.mean = x
+            self.m2 = torch.zeros_like(x)
+        else:
+            delta = x - self.mean
+            self.mean = self.mean + delta / self.n
+            self.m2 = self.m2 + delta * (x - self.mean)
+
+    def update_batch(self, xs):
+        """add the samples stacked along the first dimension of xs"""
+        other = RunningMoments()
+        other.n = xs.shape[0]
+        other.mean = xs.mean(dim=0)
+        other.m2 = ((xs - other.mean) ** 2).sum(dim=0)
+        self.merge(other)
+
+    def merge(self, other):
+        """add the samples of the moments other"""
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean, other.m2
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.n / n
+        self.m2 = self.m2 + other.m2 + delta**2 * self.n * other.n / n
+        self.n = n
+
+    def var(self, unbiased=False):
+        return self.m2 / (self.n - 1 if unbiased else self.n)
+
+
 def compute_typicality_score(train_log_likelihood, test_example_log_like):
 
     log_like_mean = train_log_likelihood.mean()